@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Wallet, Currency, Transaction, WalletHistory, ExchangeRate, Operation
+from .models import Wallet, Currency, Transaction, WalletHistory, ExchangeRate, Operation, WalletBalanceSnapshot, \
+    WalletDailyTotal
 
 admin.site.register(Wallet)
 admin.site.register(Currency)
@@ -7,3 +8,5 @@ admin.site.register(Transaction)
 admin.site.register(WalletHistory)
 admin.site.register(ExchangeRate)
 admin.site.register(Operation)
+admin.site.register(WalletBalanceSnapshot)
+admin.site.register(WalletDailyTotal)
@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
+
+
+class ApiConfig(AppConfig):
+    name = 'api'
+
+    def ready(self):
+        from .cache import currency_registry
+        from .models import Currency
+
+        # Currency changes made by this process are seen at once, the other processes reload after the TTL
+        post_save.connect(currency_registry.refresh_on_change, sender=Currency,
+                          dispatch_uid='currency_registry_save')
+        post_delete.connect(currency_registry.refresh_on_change, sender=Currency,
+                            dispatch_uid='currency_registry_delete')
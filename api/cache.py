@@ -0,0 +1,190 @@
+import time
+import uuid
+import threading
+from bisect import bisect_right
+from types import MappingProxyType
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from .models import Currency, ExchangeRate, Wallet
+
+
+class ExchangeRateCache(object):
+    """
+    In-process cache of exchange rates. Every currency has a timeline of its rates sorted by date, the rate in
+    effect at a given time is found with a binary search. Timelines are loaded lazily on the first lookup, the
+    least recently used are evicted when there are more than `size` of them and expire after `ttl` seconds.
+    Invalidations are published as a new version in the default cache, every process drops its timelines when it
+    finds the version changed on its next sync (see sync).
+    """
+    version_key = 'exchange-rates-version'
+
+    def __init__(self, size, ttl, max_points):
+        self.size = size
+        self.ttl = ttl
+        self.max_points = max_points
+        self.hits = 0
+        self.misses = 0
+        self._timelines = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _load(self, currency_id):
+        rates = list(ExchangeRate.objects.filter(currency_id=currency_id).order_by('-created')
+                     .values_list('created', 'rate')[:self.max_points])
+        rates.reverse()
+        # A timeline cut by max_points does not know the rates older than its first point.
+        complete = len(rates) < self.max_points
+        return time.monotonic(), complete, [created for created, _ in rates], [rate for _, rate in rates]
+
+    def _get_timeline(self, currency_id):
+        with self._lock:
+            timeline = self._timelines.get(currency_id)
+            if timeline and time.monotonic() - timeline[0] < self.ttl:
+                self._timelines.move_to_end(currency_id)
+                self.hits += 1
+                return timeline
+            self.misses += 1
+
+        timeline = self._load(currency_id)
+        with self._lock:
+            self._timelines[currency_id] = timeline
+            self._timelines.move_to_end(currency_id)
+            while len(self._timelines) > self.size:
+                self._timelines.popitem(last=False)
+        return timeline
+
+    def get_rate(self, currency_id, date):
+        """
+        Last exchange rate of the currency at the given time or None
+        """
+        _, complete, dates, rates = self._get_timeline(currency_id)
+        index = bisect_right(dates, date)
+        if index:
+            return rates[index - 1]
+        if not complete:
+            self.misses += 1
+            rate = ExchangeRate.objects.filter(currency_id=currency_id, created__lte=date).order_by('-created')\
+                .first()
+            if rate:
+                return rate.rate
+
+    def sync(self):
+        """
+        Drop all the timelines if rates were invalidated by any process since the last sync, one cache read.
+        Called before transactions are created or settled, so they see the rates saved before.
+        """
+        version = cache.get(self.version_key)
+        with self._lock:
+            if version != self._version:
+                self._timelines.clear()
+                self._version = version
+
+    def invalidate(self, currency_id=None):
+        """
+        Drop the timeline of a currency, or all of them, here at once and in the other processes on their next sync
+        """
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+        with self._lock:
+            if currency_id is None:
+                self._timelines.clear()
+            else:
+                self._timelines.pop(currency_id, None)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, currencies=len(self._timelines))
+
+
+rate_cache = ExchangeRateCache(settings.EXCHANGE_RATE_CACHE_SIZE, settings.EXCHANGE_RATE_CACHE_TTL,
+                               settings.EXCHANGE_RATE_CACHE_MAX_POINTS)
+
+
+class CurrencyRegistry(object):
+    """
+    Process-wide read-only copy of the Currency table, keyed by pk and by ISO code. It is loaded on the first
+    lookup, reloaded after `ttl` seconds and at once when a currency is saved or deleted in this process.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._loaded = None
+        self._by_pk = self._by_iso = MappingProxyType({})
+        self._lock = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._loaded is None or time.monotonic() - self._loaded >= self.ttl:
+                currencies = list(Currency.objects.all())
+                self._by_pk = MappingProxyType({currency.pk: currency for currency in currencies})
+                self._by_iso = MappingProxyType({currency.currency: currency for currency in currencies})
+                self._loaded = time.monotonic()
+            return self._by_pk, self._by_iso
+
+    def by_pk(self):
+        """
+        Read-only pk -> Currency mapping
+        """
+        return self._get()[0]
+
+    def get(self, pk):
+        return self._get()[0].get(pk)
+
+    def get_by_iso(self, iso):
+        return self._get()[1].get(iso)
+
+    def refresh(self):
+        with self._lock:
+            self._loaded = None
+
+    def refresh_on_change(self, **kwargs):
+        self.refresh()
+
+
+currency_registry = CurrencyRegistry(settings.CURRENCY_REGISTRY_TTL)
+
+
+WalletRef = namedtuple('WalletRef', ('pk', 'name', 'currency_id'))
+
+
+class WalletNameCache(object):
+    """
+    Wallet name -> WalletRef(pk, name, currency_id) in the default cache, shared by the processes when the cache
+    is. Names never change, so found wallets are kept for `ttl` seconds. Unknown names are remembered for
+    `negative_ttl` seconds and forgotten at once when the wallet is created here (see invalidate).
+    """
+    missing = 0
+
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def _key(self, name):
+        return 'wallet-name-{}'.format(name)
+
+    def get_many(self, names):
+        """
+        WalletRef of every name, None for the names without a wallet
+        """
+        keys = {self._key(name): name for name in names}
+        found = {keys[key]: value for key, value in cache.get_many(list(keys)).items()}
+
+        unknown = [name for name in names if name not in found]
+        if unknown:
+            wallets = {name: WalletRef(pk, name, currency_id) for pk, name, currency_id in
+                       Wallet.objects.filter(name__in=unknown).values_list('pk', 'name', 'currency_id')}
+            for name in unknown:
+                wallet = wallets.get(name)
+                cache.set(self._key(name), tuple(wallet) if wallet else self.missing,
+                          self.ttl if wallet else self.negative_ttl)
+                found[name] = wallet
+
+        return {name: WalletRef(*found[name]) if found[name] else None for name in names}
+
+    def get(self, name):
+        return self.get_many([name])[name]
+
+    def invalidate(self, name):
+        cache.delete(self._key(name))
+
+
+wallet_names = WalletNameCache(settings.WALLET_NAME_CACHE_TTL, settings.WALLET_NAME_CACHE_NEGATIVE_TTL)
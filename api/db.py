@@ -0,0 +1,55 @@
+from django.db import connections, router, transaction
+from django.db.models import F
+
+
+def bulk_insert(model, objs, batch_size=None):
+    """
+    Bulk INSERT that always leaves primary keys on the saved objects.
+    PostgreSQL returns them from a single statement, other backends fall back to row by row inserts.
+    """
+    objs = list(objs)
+    using = router.db_for_write(model)
+    if connections[using].features.can_return_ids_from_bulk_insert:
+        return model.objects.using(using).bulk_create(objs, batch_size=batch_size)
+
+    for obj in objs:
+        obj.save(force_insert=True, using=using)
+    return objs
+
+
+def upsert(model, rows, conflict_fields, update_fields=(), increment_fields=()):
+    """
+    INSERT rows (dicts of column values) or, for the rows that already exist by conflict_fields, UPDATE update_fields
+    with the new values and add the new values to increment_fields. PostgreSQL does it with one INSERT ... ON CONFLICT
+    statement, other backends row by row. The rows must be unique by conflict_fields.
+    """
+    if not rows:
+        return
+    using = router.db_for_write(model)
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        for row in rows:
+            lookup = {field: row[field] for field in conflict_fields}
+            updates = dict({field: row[field] for field in update_fields},
+                           **{field: F(field) + row[field] for field in increment_fields})
+            with transaction.atomic(using=using):
+                if not model.objects.using(using).filter(**lookup).update(**updates):
+                    model.objects.using(using).create(**row)
+        return
+
+    opts = model._meta
+    names = list(rows[0])
+    fields = [opts.get_field(name) for name in names]
+    qn = connection.ops.quote_name
+    updates = ['{0} = EXCLUDED.{0}'.format(qn(opts.get_field(name).column)) for name in update_fields] + \
+        ['{0} = {1}.{0} + EXCLUDED.{0}'.format(qn(opts.get_field(name).column), qn(opts.db_table))
+         for name in increment_fields]
+    sql = 'INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT ({conflict}) DO UPDATE SET {update}'.format(
+        table=qn(opts.db_table),
+        columns=', '.join(qn(field.column) for field in fields),
+        values=', '.join(['({})'.format(', '.join(['%s'] * len(fields)))] * len(rows)),
+        conflict=', '.join(qn(opts.get_field(name).column) for name in conflict_fields),
+        update=', '.join(updates))
+    params = [field.get_db_prep_save(row[name], connection) for row in rows for name, field in zip(names, fields)]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
@@ -0,0 +1,255 @@
+import time
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError, DataError
+from rest_framework import serializers
+from django.utils import timezone
+from .cache import rate_cache, wallet_names
+from .db import bulk_insert
+from .models import Transaction
+from .serializers import WalletRefillByNameSerializer, WalletToWalletByNameSerializer
+from .tasks import create_transaction, get_shard, schedule_settlement
+
+OPERATIONS = ('REFILL', 'TRANSFER')
+INGESTION_MODES = ('celery', 'direct', 'buffered')
+# Most seconds the transaction buffer waits before it retries a failed write
+BUFFER_RETRY_MAX_DELAY = 5
+
+
+def _validate_item(item, wallets):
+    """
+    Transaction data of a batch item or the errors found in it. Items are validated by the serializers of the by-name
+    endpoints against the wallets looked up for the whole batch.
+    """
+    if not isinstance(item, dict):
+        return None, {'non_field_errors': ["An object is expected."]}
+    if item.get('operation') not in OPERATIONS:
+        return None, {'operation': ['"{}" is not a valid choice.'.format(item.get('operation'))]}
+
+    serializer_class = WalletRefillByNameSerializer if item['operation'] == 'REFILL' else \
+        WalletToWalletByNameSerializer
+    serializer = serializer_class(data=item, context={'wallets': wallets})
+    if not serializer.is_valid():
+        return None, serializer.errors
+    return _transaction_data(serializer.validated_data), None
+
+
+def _item_names(item):
+    if not isinstance(item, dict):
+        return []
+    return [item.get(field) for field in ('name', 'from_name', 'to_name') if isinstance(item.get(field), str)]
+
+
+def refill_by_name(name, amount):
+    """
+    Transaction data of a refill of the wallet `name`, raises serializers.ValidationError
+    """
+    serializer = WalletRefillByNameSerializer(data=dict(name=name, amount=amount))
+    if not serializer.is_valid():
+        raise serializers.ValidationError(serializer.errors)
+    return _transaction_data(serializer.validated_data)
+
+
+def transfer_by_name(from_name, to_name, currency_use, amount):
+    """
+    Transaction data of a transfer between wallets by name, raises serializers.ValidationError
+    """
+    serializer = WalletToWalletByNameSerializer(data=dict(from_name=from_name, to_name=to_name,
+                                                          currency_use=currency_use, amount=amount))
+    if not serializer.is_valid():
+        raise serializers.ValidationError(serializer.errors)
+    return _transaction_data(serializer.validated_data)
+
+
+def _transaction_data(validated_data):
+    """
+    Transaction data of a refill or a transfer validated by its by-name serializer
+    """
+    if 'name' in validated_data:
+        wallet = validated_data['name']
+        return dict(wallet_to_id=wallet.pk, currency_id=wallet.currency_id, amount=validated_data['amount'],
+                    operation='REFILL')
+
+    wallet_from = validated_data['wallet_from']
+    wallet_to = validated_data['wallet_to']
+    return dict(
+        operation='TRANSFER',
+        wallet_from_id=wallet_from.pk,
+        wallet_to_id=wallet_to.pk,
+        currency_id=wallet_from.currency_id if validated_data['currency_use'] == 'FROM' else wallet_to.currency_id,
+        amount=validated_data['amount'])
+
+
+def submit_batch(items):
+    """
+    Validate and create the transactions of a batch. Wallet names are resolved with one lookup, the accepted
+    transactions are inserted with one INSERT and settlement is signalled once per shard. Returns a result per
+    item: {"index", "result": "accepted", "id"} or {"index", "result": "rejected", "errors"}.
+    """
+    wallets = wallet_names.get_many(list({name for item in items for name in _item_names(item)}))
+    rate_cache.sync()
+    now = timezone.now()
+    rates = {}
+
+    results, accepted = [], []
+    for index, item in enumerate(items):
+        data, errors = _validate_item(item, wallets)
+        if data:
+            currency_id = data['currency_id']
+            if currency_id not in rates:
+                rates[currency_id] = rate_cache.get_rate(currency_id, now)
+            if not rates[currency_id]:
+                data, errors = None, {'non_field_errors': ["Exchange rate not exists"]}
+        if errors:
+            results.append(dict(index=index, result='rejected', errors=errors))
+            continue
+        result = dict(index=index, result='accepted', id=None)
+        results.append(result)
+        accepted.append((result, Transaction(**data)))
+
+    with transaction.atomic():
+        bulk_insert(Transaction, [tran for _, tran in accepted])
+    for result, tran in accepted:
+        result['id'] = tran.pk
+
+    _schedule([tran for _, tran in accepted])
+    return results
+
+
+def _schedule(transactions):
+    for shard in {get_shard(tran.wallet_from_id, tran.wallet_to_id) for tran in transactions}:
+        schedule_settlement(shard)
+
+
+class TransactionBuffer(object):
+    """
+    In-process write-behind buffer of new transactions. A background thread inserts the buffered transactions with
+    one INSERT every `interval` seconds, or as soon as `size` of them are waiting, and signals their settlement.
+    A write that fails is retried with a growing delay, the transactions stay in the buffer until then. Only
+    transactions that cannot be written are dropped and logged: without an exchange rate (like create_transaction
+    drops them) or rejected by the database. With interval 0 transactions are written at once by the caller.
+    """
+
+    def __init__(self, interval, size):
+        self.interval = interval
+        self.size = size
+        self._items = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def append(self, data):
+        if not self.interval:
+            self._write([data])
+            return
+        with self._lock:
+            self._items.append(data)
+            waiting = len(self._items)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='transaction-buffer', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush_at_exit)
+        if waiting >= self.size:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Write the buffered transactions, returns their number. If the write fails they go back to the front of the
+        buffer and the error is raised.
+        """
+        with self._lock:
+            items, self._items = self._items, []
+        if items:
+            try:
+                self._write(items)
+            except Exception:
+                with self._lock:
+                    self._items[:0] = items
+                raise
+        return len(items)
+
+    def flush_at_exit(self):
+        """
+        Last write when the process exits, the transactions that cannot be written are lost
+        """
+        try:
+            self.flush()
+        except Exception as err:
+            logging.error('Transaction buffer: %s transactions lost: %s', len(self._items), err)
+
+    def _run(self):
+        failures = 0
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                failures = 0
+            except Exception as err:
+                failures += 1
+                delay = min(self.interval * 2 ** failures, BUFFER_RETRY_MAX_DELAY)
+                logging.warning('Transaction buffer: %s, %s transactions kept, retry in %.3fs',
+                                err, len(self._items), delay)
+                time.sleep(delay)
+            finally:
+                connection.close_if_unusable_or_obsolete()
+
+    def _insert(self, rows):
+        """
+        Insert the transactions of the rows with one INSERT. If the database rejects it, they are inserted one by one
+        and the rejected ones are dropped. Returns the inserted transactions.
+        """
+        transactions = [Transaction(**data) for data in rows]
+        try:
+            with transaction.atomic():
+                bulk_insert(Transaction, transactions)
+            return transactions
+        except (IntegrityError, DataError):
+            pass
+        inserted = []
+        for data, tran in zip(rows, transactions):
+            try:
+                with transaction.atomic():
+                    bulk_insert(Transaction, [tran])
+                inserted.append(tran)
+            except (IntegrityError, DataError) as err:
+                logging.error('Transaction %s dropped: %s', data, err)
+        return inserted
+
+    def _write(self, items):
+        rate_cache.sync()
+        now = timezone.now()
+        rows = []
+        for data in items:
+            if rate_cache.get_rate(data['currency_id'], now):
+                rows.append(data)
+            else:
+                logging.error('Transaction %s dropped: Exchange rate not exists', data)
+        transactions = self._insert(rows)
+        try:
+            _schedule(transactions)
+        except Exception as err:
+            # The transactions are written, the safety net run settles them
+            logging.warning('Transaction buffer: %s', err)
+
+
+transaction_buffer = TransactionBuffer(settings.TRANSACTION_BUFFER_INTERVAL, settings.TRANSACTION_BUFFER_SIZE)
+
+
+def ingest_transaction(data):
+    """
+    Create a transaction accepted by the API according to TRANSACTION_INGESTION_MODE:
+    celery - create_transaction task through the broker,
+    direct - insert it in the web process,
+    buffered - insert it with the next write of the transaction buffer.
+    Settlement stays asynchronous in every mode.
+    """
+    mode = settings.TRANSACTION_INGESTION_MODE
+    if mode == 'direct':
+        create_transaction(data)
+    elif mode == 'buffered':
+        transaction_buffer.append(data)
+    else:
+        create_transaction.delay(data)
@@ -0,0 +1,32 @@
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from api.rates import read_rates, load_rates, RatesError
+
+
+class Command(BaseCommand):
+    help = 'Load exchange rates from a JSON array or a CSV file with a currency,rate,created header'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to load, - for the standard input')
+        parser.add_argument('--format', choices=['json', 'csv'],
+                            help='File format, by default from the file extension (json for the standard input)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'json')
+        started = time.time()
+        try:
+            if path == '-':
+                content = sys.stdin.read()
+            else:
+                with open(path, encoding='utf-8-sig') as rates_file:
+                    content = rates_file.read()
+            loaded = load_rates(read_rates(content, file_format))
+        except RatesError as err:
+            for number, errors in sorted(err.errors.items()):
+                self.stderr.write('Row {}: {}'.format(number, '; '.join(errors)))
+            raise CommandError(err)
+        except (OSError, ValueError) as err:
+            raise CommandError(err)
+        self.stdout.write('{} exchange rates loaded in {:.3f}s'.format(loaded, time.time() - started))
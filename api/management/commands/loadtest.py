@@ -0,0 +1,174 @@
+import json
+import time
+import random
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Max
+from django.test import Client, override_settings
+from django.utils import timezone
+from payment_system.celeryconf import app
+from payment_system.pagination import ResultsSetPagination
+from api.ingestion import INGESTION_MODES, transaction_buffer
+from api.models import Currency, ExchangeRate, Transaction, Wallet
+
+WALLET_PREFIX = 'loadtest-'
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(round(q / 100.0 * len(values) + 0.5)) - 1)]
+
+
+def summarize(values):
+    return dict(count=len(values), p50=percentile(values, 50), p95=percentile(values, 95),
+                p99=percentile(values, 99), max=max(values) if values else None)
+
+
+@contextmanager
+def celery_mode(mode):
+    """
+    eager: tasks run inside the request (CELERY_TASK_ALWAYS_EAGER).
+    broker: tasks go through an in-memory broker to a worker thread, a local stand-in for RabbitMQ.
+    """
+    # The app reads the Django settings with the CELERY_ namespace, so the keys are overridden with their prefix.
+    conf = app.conf
+    saved = conf.task_always_eager, conf.broker_url
+    try:
+        if mode == 'eager':
+            conf.CELERY_TASK_ALWAYS_EAGER = True
+            yield
+        else:
+            from celery.contrib.testing import tasks  # noqa: registers the ping task used by start_worker
+            from celery.contrib.testing.worker import start_worker
+            conf.CELERY_TASK_ALWAYS_EAGER = False
+            conf.CELERY_BROKER_URL = 'memory://'
+            queues = ['celery'] + [settings.SETTLEMENT_QUEUE.format(shard)
+                                   for shard in range(settings.SETTLEMENT_SHARDS)]
+            with start_worker(app, pool='solo', perform_ping_check=False, queues=queues):
+                yield
+    finally:
+        conf.CELERY_TASK_ALWAYS_EAGER, conf.CELERY_BROKER_URL = saved
+
+
+class Command(BaseCommand):
+    help = 'Load test of the ingestion and report endpoints, writes latency percentiles and settlement lag to a JSON ' \
+           'file. Runs against the configured database and creates its own "{}N" wallets.'.format(WALLET_PREFIX)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--wallets', type=int, default=100)
+        parser.add_argument('--mode', choices=['eager', 'broker'], default='eager')
+        parser.add_argument('--ingestion', choices=INGESTION_MODES, help='TRANSACTION_INGESTION_MODE for the run')
+        parser.add_argument('--settlement-timeout', type=float, default=60, help='Seconds to wait for settlement')
+        parser.add_argument('--output', default='loadtest.json')
+
+    def _setup_wallets(self, count):
+        currency = Currency.objects.get(currency='USD')
+        if not ExchangeRate.objects.filter(currency=currency, created__lte=timezone.now()).exists():
+            ExchangeRate.objects.create(currency=currency, rate=1, created=timezone.now() - datetime.timedelta(days=1))
+        names = ['{}{}'.format(WALLET_PREFIX, i) for i in range(count)]
+        existing = set(Wallet.objects.filter(name__in=names).values_list('name', flat=True))
+        Wallet.objects.bulk_create([Wallet(name=name, city='Load', country='Test', currency=currency, balance=10 ** 9)
+                                    for name in names if name not in existing])
+        return names
+
+    def _requests(self, endpoint, names, count):
+        pages = max(1, Wallet.objects.count() // ResultsSetPagination.page_size)
+        for _ in range(count):
+            if endpoint == 'wallet_refill_by_name':
+                yield 'post', '/api/wallet_refill_by_name/{}'.format(random.choice(names)), {'amount': 1}
+            elif endpoint == 'wallet2wallet_by_name':
+                from_name, to_name = random.sample(names, 2)
+                yield 'post', '/api/wallet2wallet_by_name/{}/{}'.format(from_name, to_name), \
+                    {'amount': 1, 'currency_use': 'FROM'}
+            elif endpoint == 'client':
+                yield 'get', '/api/client', {'page': random.randint(1, pages)}
+            else:
+                yield 'get', '/api/client_report', {'name': random.choice(names)}
+
+    def _run(self, jobs, concurrency):
+        """
+        Run the requests, returns (endpoint, status, seconds) for each of them
+        """
+        def worker(chunk):
+            client = Client()
+            results = []
+            for endpoint, method, url, data in chunk:
+                started = time.time()
+                response = getattr(client, method)(url, data=data)
+                results.append((endpoint, response.status_code, time.time() - started))
+            if concurrency > 1:
+                connection.close()
+            return results
+
+        chunks = [jobs[i::concurrency] for i in range(concurrency)]
+        if concurrency == 1:
+            return worker(chunks[0])
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return [result for results in executor.map(worker, chunks) for result in results]
+
+    def _settlement_lag(self, started, expected, timeout):
+        """
+        Wait until the accepted transactions are settled, lag is the time from creation to settlement
+        """
+        transactions = Transaction.objects.filter(created__gte=started, wallet_to__name__startswith=WALLET_PREFIX)
+        deadline = time.time() + timeout
+        while time.time() < deadline and (transactions.count() < expected or
+                                          transactions.filter(status__in=['pending', 'claimed']).exists()):
+            time.sleep(0.1)
+        lags = [(processed - created).total_seconds() * 1000 for created, processed in
+                transactions.filter(processed__isnull=False).values_list('created', 'processed')]
+        result = summarize(lags)
+        result['unsettled'] = transactions.filter(processed__isnull=True).count()
+        result['last_processed'] = transactions.aggregate(last=Max('processed'))['last']
+        return result
+
+    def handle(self, *args, **options):
+        names = self._setup_wallets(max(options['wallets'], 2))
+        endpoints = ['wallet_refill_by_name', 'wallet2wallet_by_name', 'client', 'client_report']
+        jobs = [(endpoint,) + request for endpoint in endpoints
+                for request in self._requests(endpoint, names, options['requests'])]
+        random.shuffle(jobs)
+
+        ingestion = options['ingestion'] or settings.TRANSACTION_INGESTION_MODE
+        with celery_mode(options['mode']), override_settings(TRANSACTION_INGESTION_MODE=ingestion):
+            started = timezone.now()
+            results = self._run(jobs, options['concurrency'])
+            elapsed = (timezone.now() - started).total_seconds()
+            transaction_buffer.flush()
+            expected = len([status for endpoint, status, _ in results
+                            if endpoint in ('wallet_refill_by_name', 'wallet2wallet_by_name') and status < 400])
+            settlement = self._settlement_lag(started, expected, options['settlement_timeout'])
+
+        report = dict(mode=options['mode'], ingestion=ingestion, concurrency=options['concurrency'], requests=len(jobs),
+                      elapsed=elapsed, endpoints={}, settlement_lag_ms=settlement)
+        for endpoint in endpoints:
+            latencies = [seconds * 1000 for name, _, seconds in results if name == endpoint]
+            statuses = [status for name, status, _ in results if name == endpoint]
+            accepted = len([status for status in statuses if status < 400])
+            report['endpoints'][endpoint] = dict(summarize(latencies), accepted=accepted,
+                                                 rejected=len([status for status in statuses if 400 <= status < 500]),
+                                                 errors=len([status for status in statuses if status >= 500]),
+                                                 accepted_per_second=accepted / elapsed if elapsed else None)
+        settlement['last_processed'] = settlement['last_processed'] and settlement['last_processed'].isoformat()
+
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+
+        for endpoint, stats in report['endpoints'].items():
+            self.stdout.write('{:<24} p50 {p50:.1f}ms  p95 {p95:.1f}ms  p99 {p99:.1f}ms  {accepted_per_second:.1f} '
+                              'req/s  {rejected} rejected  {errors} errors'.format(endpoint, **stats))
+        if settlement['count']:
+            self.stdout.write('{:<24} p50 {p50:.1f}ms  p95 {p95:.1f}ms  p99 {p99:.1f}ms  {unsettled} unsettled'
+                              .format('settlement lag', **settlement))
+        self.stdout.write('Report written to {}'.format(options['output']))
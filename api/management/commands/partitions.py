@@ -0,0 +1,41 @@
+import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from api.partitions import PARTITIONED, ARCHIVE_SCHEMA, partitions, ensure_partitions, archive_partitions
+
+
+def _month(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise CommandError('Month must be YYYY-MM: {}'.format(value))
+
+
+class Command(BaseCommand):
+    help = 'List the monthly partitions of the operation, wallet history and transaction tables, create the ' \
+           'partitions of the next months, detach or archive the partitions of old months'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['list', 'create', 'archive'])
+        parser.add_argument('--months', type=int, default=settings.PARTITION_MONTHS_AHEAD,
+                            help='Months after the current one to create the partitions of')
+        parser.add_argument('--before', help='Archive the partitions of the months before this one, YYYY-MM')
+        parser.add_argument('--detach', action='store_true',
+                            help='Only detach the partitions, leave them in the public schema')
+
+    def handle(self, *args, **options):
+        if options['action'] == 'create':
+            for name in ensure_partitions(options['months']):
+                self.stdout.write('Created {}'.format(name))
+        elif options['action'] == 'archive':
+            if not options['before']:
+                raise CommandError('--before is required')
+            for name in archive_partitions(_month(options['before']), options['detach']):
+                self.stdout.write('{} {}'.format('Detached' if options['detach'] else 'Archived', name))
+
+        for table in PARTITIONED:
+            months = partitions(table)
+            archived = partitions(table, ARCHIVE_SCHEMA)
+            self.stdout.write('{}: {} partitions{}, {} archived'.format(
+                table, len(months), ' ({:%Y-%m} to {:%Y-%m})'.format(months[0], months[-1]) if months else '',
+                len(archived)))
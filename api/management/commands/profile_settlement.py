@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from api.profiling import settlement_profiler
+
+
+class Command(BaseCommand):
+    help = 'Switch profiling of the settlement runs of the workers on this host, list the kept profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['on', 'off', 'status'])
+        parser.add_argument('--every', type=int, default=0, help='Profile every Nth run of a worker with cProfile')
+        parser.add_argument('--slow', type=float, default=0,
+                            help='Sample runs and keep the ones slower than this number of seconds')
+
+    def handle(self, *args, **options):
+        if options['action'] == 'on':
+            settlement_profiler.enable(options['every'], options['slow'])
+        elif options['action'] == 'off':
+            settlement_profiler.disable()
+
+        config = settlement_profiler.config()
+        self.stdout.write('Settlement profiling in {}: every {} run(s), slower than {}s (0 is off)'.format(
+            settlement_profiler.directory, config['every'], config['slow']))
+        for summary in settlement_profiler.profiles():
+            self.stdout.write(summary)
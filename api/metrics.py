@@ -0,0 +1,144 @@
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .db import upsert
+from .models import Metric, Transaction
+
+# Upper bounds of the histogram buckets, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS = {
+    'payment_api_request_duration_seconds': ('histogram', 'API request latency by view'),
+    'payment_api_responses_total': ('counter', 'API responses by view and status code'),
+    'payment_settlement_run_seconds': ('histogram', 'Duration of a settlement run'),
+    'payment_settlement_stage_seconds': ('histogram', 'Duration of the settlement stages of a batch'),
+    'payment_settlement_transactions_total': ('counter', 'Settled transactions by result'),
+    'payment_settlement_failures_total': ('counter', 'Settlement failures by reason'),
+    'payment_db_pool_wait_seconds': ('histogram', 'Wait for a connection of the database pool'),
+    'payment_db_pool_connections_total': ('counter', 'Database pool connections by event'),
+    'payment_transactions_pending': ('gauge', 'Transactions waiting for settlement'),
+    'payment_transactions_oldest_pending_seconds': ('gauge', 'Age of the oldest pending transaction'),
+}
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+class Metrics(object):
+    """
+    Counters and histograms of this process. They are added to the shared Metric table every `flush_interval`
+    seconds with one upsert, so that the web and the worker processes are exported together.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._values = {}
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+        atexit.register(self.flush)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram, buckets are stored cumulative as Prometheus exports them
+        """
+        with self._lock:
+            for bound in BUCKETS + (float('inf'),):
+                if value <= bound:
+                    key = (name + '_bucket', _labels(dict(labels, le='+Inf' if bound == float('inf') else bound)))
+                    self._values[key] = self._values.get(key, 0) + 1
+            for suffix, increment in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, _labels(labels))
+                self._values[key] = self._values.get(key, 0) + increment
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def flush(self):
+        """
+        Add the values to the Metric table, False if the write failed: the values are then kept for the next flush.
+        Rows are written in (name, labels) order, so concurrent flushes of several processes lock them in the same
+        order and do not deadlock.
+        """
+        with self._lock:
+            values, self._values = self._values, {}
+            self._flushed = time.monotonic()
+        try:
+            with transaction.atomic():
+                upsert(Metric, [dict(name=name, labels=labels, value=value)
+                                for (name, labels), value in sorted(values.items())],
+                       conflict_fields=('name', 'labels'), increment_fields=('value',))
+        except Exception as err:
+            logging.warning('Metrics: %s', err)
+            with self._lock:
+                for key, value in values.items():
+                    self._values[key] = self._values.get(key, 0) + value
+            return False
+        return True
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+
+metrics = Metrics(settings.METRICS_FLUSH_INTERVAL)
+
+
+def _family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _series_order(series):
+    # Histogram buckets go in the order of their bounds
+    name, labels, _ = series
+    other, bound = [], 0
+    for label in labels.split(','):
+        if label.startswith('le='):
+            bound = float(label[4:-1])
+        else:
+            other.append(label)
+    return _family(name), other, name, bound
+
+
+def render_metrics():
+    """
+    All metrics in the Prometheus text format. Queue gauges are read from the database at the time of the scrape.
+    """
+    families = {name: [] for name in METRICS}
+    for name, labels, value in sorted(Metric.objects.values_list('name', 'labels', 'value'), key=_series_order):
+        families.setdefault(_family(name), []).append((name, labels, value))
+
+    pending = Transaction.objects.filter(status='pending')
+    oldest = pending.order_by('created').values_list('created', flat=True).first()
+    families['payment_transactions_pending'].append(('payment_transactions_pending', '', pending.count()))
+    families['payment_transactions_oldest_pending_seconds'].append((
+        'payment_transactions_oldest_pending_seconds', '',
+        (timezone.now() - oldest).total_seconds() if oldest else 0))
+
+    lines = []
+    for family, series in families.items():
+        metric_type, description = METRICS.get(family, ('untyped', ''))
+        lines.append('# HELP {} {}'.format(family, description))
+        lines.append('# TYPE {} {}'.format(family, metric_type))
+        for name, labels, value in series:
+            lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', repr(float(value))))
+    return '\n'.join(lines) + '\n'
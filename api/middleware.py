@@ -0,0 +1,157 @@
+import re
+import time
+import logging
+from collections import Counter
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.signals import request_finished
+from django.db import DEFAULT_DB_ALIAS, connections, close_old_connections
+from django.http import JsonResponse
+from django.urls import resolve, Resolver404
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_500_INTERNAL_SERVER_ERROR
+from payment_system.routers import read_only
+from .metrics import metrics
+
+# Literals of a logged query, so that queries differing only by parameters count as the same
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def _flush_metrics(**kwargs):
+    # The response is sent by now, a slow or failed flush neither delays nor breaks it
+    metrics.maybe_flush()
+    # The connection of the flush is given back as at the end of the request (not in the atomic block of a test)
+    if not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        close_old_connections()
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Latency histogram and response counter of every API view. The metrics are flushed when the request is finished,
+    after the response is sent.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        request_finished.connect(_flush_metrics, dispatch_uid='request_metrics_flush')
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        if match:
+            view = match.url_name or match.view_name
+            metrics.observe('payment_api_request_duration_seconds', time.perf_counter() - started, view=view,
+                            method=request.method)
+            metrics.inc('payment_api_responses_total', view=view, status=response.status_code)
+        return response
+
+
+class JSONErrorMiddleware(object):
+    """
+    Errors of the API views as JSON: Django validation errors are 400, any other error is 500 with
+    {"non_field_errors": [...]}. Errors of DRF (serializers.ValidationError and other API exceptions) are already
+    answered by the views.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if not request.path.startswith('/api/'):
+            return None
+        if isinstance(exception, ValidationError):
+            if hasattr(exception, 'error_dict'):
+                data = exception.message_dict
+            else:
+                data = getattr(exception, 'message', exception.messages)
+            return JsonResponse(data, status=HTTP_400_BAD_REQUEST, safe=False)
+        logging.warning('%s %s: %s', request.method, request.path, exception, exc_info=True)
+        return JsonResponse({'non_field_errors': ["{}".format(exception)]}, status=HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class SQLProfilingMiddleware(object):
+    """
+    Queries and database time of every request, enabled by SQL_PROFILING. With SQL_PROFILING_HEADERS they are
+    returned in the X-DB-Queries, X-DB-Time (ms) and X-DB-Repeated headers. Requests with more than
+    SQL_PROFILING_MAX_QUERIES queries or slower than SQL_PROFILING_SLOW_MS are logged, as are queries repeated
+    SQL_PROFILING_REPEATED_QUERIES times or more with different parameters only (N+1).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.SQL_PROFILING:
+            return self.get_response(request)
+
+        debug_cursors, started_at = {}, {}
+        for connection in connections.all():
+            debug_cursors[connection.alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            started_at[connection.alias] = len(connection.queries_log)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            queries = []
+            for connection in connections.all():
+                queries += list(connection.queries_log)[started_at.get(connection.alias, 0):]
+                connection.force_debug_cursor = debug_cursors.get(connection.alias, False)
+        elapsed = (time.perf_counter() - started) * 1000
+
+        db_time = sum(float(query['time']) for query in queries) * 1000
+        repeated = [(sql, count) for sql, count in
+                    Counter(SQL_LITERALS.sub('?', query['sql']) for query in queries).most_common()
+                    if count >= settings.SQL_PROFILING_REPEATED_QUERIES]
+        if settings.SQL_PROFILING_HEADERS:
+            response['X-DB-Queries'] = len(queries)
+            response['X-DB-Time'] = '{:.1f}'.format(db_time)
+            response['X-DB-Repeated'] = sum(count for _, count in repeated)
+
+        if len(queries) > settings.SQL_PROFILING_MAX_QUERIES or elapsed > settings.SQL_PROFILING_SLOW_MS:
+            logging.warning('%s %s: %s queries, %.1f ms in the database, %.1f ms total', request.method,
+                            request.path, len(queries), db_time, elapsed)
+        for sql, count in repeated:
+            logging.warning('%s %s: query repeated %s times: %s', request.method, request.path, count, sql)
+        return response
+
+
+def _read_only_stream(content):
+    with read_only():
+        yield from content
+
+
+class ReplicaReadsMiddleware(object):
+    """
+    Safe requests to the views with replica_reads read from a replica, streamed responses included. A successful
+    unsafe request pins the client to the primary for REPLICA_PIN_SECONDS with a cookie, so it reads its own writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in SAFE_METHODS:
+            if request.COOKIES.get(settings.REPLICA_PIN_COOKIE) or not self.replica_reads(request):
+                return self.get_response(request)
+            with read_only():
+                response = self.get_response(request)
+            if response.streaming:
+                response.streaming_content = _read_only_stream(response.streaming_content)
+            return response
+
+        response = self.get_response(request)
+        if response.status_code < 400:
+            response.set_cookie(settings.REPLICA_PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS)
+        return response
+
+    def replica_reads(self, request):
+        try:
+            view = resolve(request.path_info).func
+        except Resolver404:
+            return False
+        return getattr(getattr(view, 'cls', None), 'replica_reads', False)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Ожидает обработки'), ('claimed', 'Обрабатывается'), ('done', 'Проведена'), ('failed', 'Отклонена')], default='pending', max_length=10, verbose_name='Статус транзакции'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='claimed',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата начала обработки'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='processed',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата обработки'),
+        ),
+        # Everything that is neither done nor started was waiting for processing_transactions.
+        migrations.RunSQL(
+            ["UPDATE api_transaction SET status = 'pending' WHERE status NOT IN ('start', 'done')"],
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            ["CREATE INDEX api_transaction_pending ON api_transaction (created, id) WHERE status = 'pending'"],
+            ["DROP INDEX api_transaction_pending"],
+        ),
+        # release_stale_claims looks up the claimed rows by claim date
+        migrations.RunSQL(
+            ["CREATE INDEX api_transaction_claimed ON api_transaction (claimed) WHERE status = 'claimed'"],
+            ["DROP INDEX api_transaction_claimed"],
+        ),
+    ]
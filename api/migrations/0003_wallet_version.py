@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_transaction_status_lifecycle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='version',
+            field=models.IntegerField(default=0, verbose_name='Версия баланса'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_wallet_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='wallethistory',
+            index=models.Index(fields=['wallet', 'oper_date', 'id'], name='api_wallethist_wallet_date_idx'),
+        ),
+    ]
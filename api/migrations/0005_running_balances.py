@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+# Running balances of the existing history, anchored to the current wallet balance: the last operation of a wallet
+# ends with its balance, every earlier one with that balance minus the operations after it.
+BALANCES_SQL = """
+    UPDATE api_wallethistory h SET balance_after = s.balance_after
+    FROM (
+        SELECT h.id, w.balance
+            - SUM(CASE WHEN h.type = 'IN' THEN h.amount ELSE -h.amount END) OVER (PARTITION BY h.wallet_id)
+            + SUM(CASE WHEN h.type = 'IN' THEN h.amount ELSE -h.amount END)
+                OVER (PARTITION BY h.wallet_id ORDER BY h.oper_date, h.id) AS balance_after
+        FROM api_wallethistory h JOIN api_wallet w ON w.id = h.wallet_id
+    ) s
+    WHERE h.id = s.id
+"""
+
+# Snapshot of every day a wallet had operations: the balance after its last operation of that day
+SNAPSHOTS_SQL = """
+    INSERT INTO api_walletbalancesnapshot (wallet_id, date, balance)
+    SELECT DISTINCT ON (wallet_id, (oper_date AT TIME ZONE %s)::date)
+        wallet_id, (oper_date AT TIME ZONE %s)::date, balance_after
+    FROM api_wallethistory
+    ORDER BY wallet_id, (oper_date AT TIME ZONE %s)::date, oper_date DESC, id DESC
+"""
+
+
+def backfill_balances(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(BALANCES_SQL)
+            cursor.execute(SNAPSHOTS_SQL, [settings.TIME_ZONE] * 3)
+        return
+
+    # The same backfill through the ORM on the other backends, one wallet at a time from its last operation back
+    Wallet = apps.get_model('api', 'Wallet')
+    WalletHistory = apps.get_model('api', 'WalletHistory')
+    WalletBalanceSnapshot = apps.get_model('api', 'WalletBalanceSnapshot')
+    db = connection.alias
+    for wallet in Wallet.objects.using(db).iterator():
+        balance = wallet.balance
+        snapshots = {}
+        for entry in WalletHistory.objects.using(db).filter(wallet_id=wallet.pk).order_by('-oper_date', '-pk'):
+            WalletHistory.objects.using(db).filter(pk=entry.pk).update(balance_after=balance)
+            snapshots.setdefault(timezone.localtime(entry.oper_date).date(), balance)
+            balance -= entry.amount if entry.type == 'IN' else -entry.amount
+        WalletBalanceSnapshot.objects.using(db).bulk_create([
+            WalletBalanceSnapshot(wallet_id=wallet.pk, date=date, balance=closing) for date, closing in snapshots.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_wallethistory_report_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletBalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='День')),
+                ('balance', models.BigIntegerField(verbose_name='Баланс на конец дня')),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='snapshots', to='api.Wallet', verbose_name='Кошелек')),
+            ],
+            options={
+                'verbose_name': 'Баланс кошелька на конец дня',
+                'verbose_name_plural': 'Балансы кошельков на конец дня',
+                'ordering': ('pk',),
+            },
+        ),
+        migrations.AddField(
+            model_name='wallethistory',
+            name='balance_after',
+            field=models.BigIntegerField(null=True, verbose_name='Баланс кошелька после операции'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='walletbalancesnapshot',
+            unique_together=set([('wallet', 'date')]),
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
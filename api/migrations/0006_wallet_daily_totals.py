@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+TOTALS_SQL = """
+    INSERT INTO api_walletdailytotal (wallet_id, date, type, currency_id, count, amount, usd_amount)
+    SELECT h.wallet_id, (h.oper_date AT TIME ZONE %s)::date, h.type, o.currency_id,
+        COUNT(*), SUM(h.amount), SUM(o.usd_amount)
+    FROM api_wallethistory h JOIN api_operation o ON o.id = h.oper_id
+    GROUP BY h.wallet_id, (h.oper_date AT TIME ZONE %s)::date, h.type, o.currency_id
+"""
+
+
+def backfill_totals(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(TOTALS_SQL, [settings.TIME_ZONE] * 2)
+        return
+
+    # The same totals summed up through the ORM on the other backends
+    WalletHistory = apps.get_model('api', 'WalletHistory')
+    WalletDailyTotal = apps.get_model('api', 'WalletDailyTotal')
+    db = connection.alias
+    totals = {}
+    history = WalletHistory.objects.using(db) \
+        .values_list('wallet_id', 'oper_date', 'type', 'oper__currency_id', 'amount', 'oper__usd_amount')
+    for wallet_id, oper_date, type_, currency_id, amount, usd_amount in history.iterator():
+        key = (wallet_id, timezone.localtime(oper_date).date(), type_, currency_id)
+        count, total, usd_total = totals.get(key, (0, 0, 0))
+        totals[key] = (count + 1, total + amount, usd_total + usd_amount)
+    WalletDailyTotal.objects.using(db).bulk_create([
+        WalletDailyTotal(wallet_id=wallet_id, date=date, type=type_, currency_id=currency_id, count=count,
+                         amount=amount, usd_amount=usd_amount)
+        for (wallet_id, date, type_, currency_id), (count, amount, usd_amount) in totals.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_running_balances'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletDailyTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='День')),
+                ('type', models.CharField(max_length=3, verbose_name='Тип операции (списание, пополнение)')),
+                ('count', models.IntegerField(verbose_name='Количество операций')),
+                ('amount', models.BigIntegerField(verbose_name='Cумма операций в валюте кошелька')),
+                ('usd_amount', models.BigIntegerField(verbose_name='Cумма операций в USD')),
+                ('currency', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='api.Currency', verbose_name='Валюта операции')),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='daily_totals', to='api.Wallet', verbose_name='Кошелек')),
+            ],
+            options={
+                'verbose_name': 'Итоги операций кошелька за день',
+                'verbose_name_plural': 'Итоги операций кошельков за день',
+                'ordering': ('pk',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='walletdailytotal',
+            unique_together=set([('wallet', 'date', 'type', 'currency')]),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
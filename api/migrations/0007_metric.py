@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_wallet_daily_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Metric',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Метрика')),
+                ('labels', models.CharField(blank=True, max_length=255, verbose_name='Метки')),
+                ('value', models.FloatField(default=0, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Метрика',
+                'verbose_name_plural': 'Метрики',
+                'ordering': ('pk',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='metric',
+            unique_together=set([('name', 'labels')]),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+# Tables partitioned by month of their date column. The default partition takes rows of months without a partition.
+TABLES = (('api_operation', 'created'), ('api_wallethistory', 'oper_date'), ('api_transaction', 'created'))
+MONTHS_AHEAD = 3
+
+
+def _next_month(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _months(first, last):
+    month = datetime.date(first.year, first.month, 1)
+    while month <= last:
+        yield month
+        month = _next_month(month)
+
+
+def _bound(month):
+    return datetime.datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+def _rebuild(cursor, table, column, partitioned):
+    """
+    Recreate a table as a partitioned one, or back as a plain table, with its data, indexes and foreign keys
+    """
+    cursor.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+                   "AND indexname != %s", [table, table + '_pkey'])
+    indexes = [indexdef.replace(' ON ONLY ', ' ON ') for indexdef, in cursor.fetchall()]
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass AND contype = 'f'", [table])
+    foreign_keys = cursor.fetchall()
+
+    cursor.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(table))
+    if partitioned:
+        cursor.execute('CREATE TABLE {0} (LIKE {0}_old INCLUDING DEFAULTS) PARTITION BY RANGE ({1})'.format(
+            table, column))
+        cursor.execute('CREATE TABLE {0}_default PARTITION OF {0} DEFAULT'.format(table))
+        cursor.execute('SELECT min({}) FROM {}_old'.format(column, table))
+        today = timezone.now().date()
+        first = cursor.fetchone()[0]
+        for month in _months(first.date() if first else today, today + datetime.timedelta(days=31 * MONTHS_AHEAD)):
+            cursor.execute('CREATE TABLE {0}_p{1:%Y_%m} PARTITION OF {0} FOR VALUES FROM (%s) TO (%s)'.format(
+                table, month), [_bound(month), _bound(_next_month(month))])
+    else:
+        cursor.execute('CREATE TABLE {0} (LIKE {0}_old INCLUDING DEFAULTS)'.format(table))
+    cursor.execute('INSERT INTO {0} SELECT * FROM {0}_old'.format(table))
+    cursor.execute('ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id'.format(table))
+    cursor.execute('DROP TABLE {0}_old'.format(table))
+
+    # The primary key of a partitioned table must contain the partition column
+    cursor.execute('ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY (id{1})'.format(
+        table, ', ' + column if partitioned else ''))
+    for indexdef in indexes:
+        cursor.execute(indexdef)
+    for name, definition in foreign_keys:
+        cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(table, name, definition))
+
+
+def partition_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in TABLES:
+            _rebuild(cursor, table, column, partitioned=True)
+
+
+def unpartition_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table, column in TABLES:
+            _rebuild(cursor, table, column, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_metric'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='wallethistory',
+            name='oper',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='api.Operation', verbose_name='Операция'),
+        ),
+        migrations.RunPython(partition_tables, unpartition_tables),
+    ]
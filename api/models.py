@@ -1,5 +1,8 @@
-import datetime
-from django.db import models
+from functools import reduce
+from operator import or_
+from django.db import models, transaction
+from django.db.models import F, Q, Case, When, Value
+from django.utils import timezone
 
 
 class Currency(models.Model):
@@ -16,14 +19,47 @@ class Currency(models.Model):
         return self.currency
 
 
+class WalletQuerySet(models.QuerySet):
+    """
+    Balances are changed with conditional UPDATEs only, the row is never read and saved back.
+    """
+
+    def inc_balance(self, pk, amount):
+        """
+        Add amount to the wallet balance unless it goes below zero. Returns False on overdraft.
+        """
+        return self.filter(pk=pk, balance__gte=-amount).update(
+            balance=F('balance') + amount, version=F('version') + 1) == 1
+
+    def inc_balances(self, deltas, versions):
+        """
+        Add deltas to the balances of several wallets with one UPDATE. Each wallet must still have the version it
+        was read with, otherwise nothing is changed and False is returned.
+        """
+        if not deltas:
+            return True
+        whens = [When(pk=pk, then=Value(delta)) for pk, delta in deltas.items()]
+        condition = reduce(or_, [Q(pk=pk, version=versions[pk]) for pk in deltas])
+        with transaction.atomic():
+            updated = self.filter(condition).update(
+                balance=F('balance') + Case(*whens, output_field=models.BigIntegerField()),
+                version=F('version') + 1)
+            if updated != len(deltas):
+                transaction.set_rollback(True)
+        return updated == len(deltas)
+
+
 class Wallet(models.Model):
     name = models.CharField(max_length=255, unique=True, db_index=True, verbose_name='Имя клиента')
     city = models.CharField(max_length=60, verbose_name='Страна')
     country = models.CharField(max_length=180, verbose_name='Город проживания')
     created = models.DateTimeField(auto_now_add=True, verbose_name='Дата регистрации')
     balance = models.BigIntegerField(default=0, verbose_name='Баланс')
+    version = models.IntegerField(default=0, verbose_name='Версия баланса')
     currency = models.ForeignKey('api.Currency', on_delete=models.DO_NOTHING, verbose_name='Валюта кошелька')
 
+    objects = WalletQuerySet.as_manager()
+
     class Meta:
         ordering = ('pk',)
         verbose_name = 'Кошелек'
@@ -49,8 +85,7 @@ class ExchangeRate(models.Model):
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         if not self.created:
-            self.created = datetime.datetime.now()
-            self.save()
+            self.created = timezone.now()
         super().save(force_insert, force_update, using, update_fields)
 
 
@@ -69,6 +104,35 @@ class Operation(models.Model):
         verbose_name_plural = 'Операции'
 
 
+class WalletHistoryQuerySet(models.QuerySet):
+
+    def balance_at(self, wallet_id, date=None, inclusive=True):
+        """
+        Balance of the wallet at the given time (after all operations if None): the running balance after its last
+        operation up to that time, or the last end of day balance before it, 0 if there were none. With
+        inclusive=False the operations at exactly that time are not counted. One lookup of the (wallet, oper_date, id)
+        index.
+        """
+        history = self.filter(wallet_id=wallet_id, balance_after__isnull=False)
+        if date is not None:
+            history = history.filter(**{'oper_date__lte' if inclusive else 'oper_date__lt': date})
+        last = history.order_by('-oper_date', '-pk').values_list('balance_after', flat=True).first()
+        if last is None:
+            # The operations may be in archived partitions, the end of day balances are kept
+            snapshots = WalletBalanceSnapshot.objects.filter(wallet_id=wallet_id)
+            if date is not None:
+                snapshots = snapshots.filter(date__lt=timezone.localtime(date).date())
+            last = snapshots.order_by('-date').values_list('balance', flat=True).first()
+        return last or 0
+
+    def with_operation(self):
+        """
+        Rows joined with their operations by date too (an operation and its history have the same date), so that
+        only the Operation partitions of the rows are read
+        """
+        return self.filter(oper__created=F('oper_date'))
+
+
 class WalletHistory(models.Model):
     wallet = models.ForeignKey('api.Wallet', on_delete=models.DO_NOTHING, related_name='histories',
                                verbose_name='Кошелек')
@@ -77,18 +141,68 @@ class WalletHistory(models.Model):
                                        verbose_name='Кошелек, с которым проводилась операция')
     wallet_partner_name = models.CharField(max_length=255, null=True,
                                            verbose_name='Имя клиента, с которым проводилась операция')
-    oper = models.ForeignKey('api.Operation', on_delete=models.DO_NOTHING, verbose_name='Операция')
+    # Operations are partitioned by date (migration 0008), a foreign key can only point at a whole row of the table
+    oper = models.ForeignKey('api.Operation', on_delete=models.DO_NOTHING, db_constraint=False,
+                             verbose_name='Операция')
     oper_date = models.DateTimeField(db_index=True, verbose_name='Дата операции')
     type = models.CharField(max_length=3, verbose_name='Тип операции (списание, пополнение)')  # IN / OUT
     amount = models.BigIntegerField(verbose_name='Cумма операции в валюте кошелька')
+    balance_after = models.BigIntegerField(null=True, verbose_name='Баланс кошелька после операции')
+
+    objects = WalletHistoryQuerySet.as_manager()
 
     class Meta:
         ordering = ('pk',)
         verbose_name = 'История операции по кошельку'
         verbose_name_plural = 'История операций по кошелькам'
+        # Client report pages are read by (oper_date, id) within a wallet
+        indexes = [models.Index(fields=['wallet', 'oper_date', 'id'], name='api_wallethist_wallet_date_idx')]
+
+
+class WalletBalanceSnapshot(models.Model):
+    """
+    Balance of a wallet at the end of a day (TIME_ZONE), one row per wallet and day with operations
+    """
+    wallet = models.ForeignKey('api.Wallet', on_delete=models.DO_NOTHING, related_name='snapshots',
+                               verbose_name='Кошелек')
+    date = models.DateField(verbose_name='День')
+    balance = models.BigIntegerField(verbose_name='Баланс на конец дня')
+
+    class Meta:
+        ordering = ('pk',)
+        verbose_name = 'Баланс кошелька на конец дня'
+        verbose_name_plural = 'Балансы кошельков на конец дня'
+        unique_together = ('wallet', 'date')
+
+
+class WalletDailyTotal(models.Model):
+    """
+    Totals of the wallet history of a day (TIME_ZONE) by operation type and operation currency, kept by settlement
+    """
+    wallet = models.ForeignKey('api.Wallet', on_delete=models.DO_NOTHING, related_name='daily_totals',
+                               verbose_name='Кошелек')
+    date = models.DateField(verbose_name='День')
+    type = models.CharField(max_length=3, verbose_name='Тип операции (списание, пополнение)')  # IN / OUT
+    currency = models.ForeignKey('api.Currency', on_delete=models.DO_NOTHING, verbose_name='Валюта операции')
+    count = models.IntegerField(verbose_name='Количество операций')
+    amount = models.BigIntegerField(verbose_name='Cумма операций в валюте кошелька')
+    usd_amount = models.BigIntegerField(verbose_name='Cумма операций в USD')
+
+    class Meta:
+        ordering = ('pk',)
+        verbose_name = 'Итоги операций кошелька за день'
+        verbose_name_plural = 'Итоги операций кошельков за день'
+        unique_together = ('wallet', 'date', 'type', 'currency')
 
 
 class Transaction(models.Model):
+    STATUSES = (
+        ('pending', 'Ожидает обработки'),
+        ('claimed', 'Обрабатывается'),
+        ('done', 'Проведена'),
+        ('failed', 'Отклонена'),
+    )
+
     wallet_from = models.ForeignKey('api.Wallet', null=True, db_index=True, related_name='in_transactions',
                                     on_delete=models.DO_NOTHING,
                                     verbose_name='Кошелек, с которого снимают деньги')
@@ -97,11 +211,27 @@ class Transaction(models.Model):
     operation = models.CharField(max_length=20,
                                  verbose_name='Название операции')  # REFILL– replenishment, TRANSFER - transfer
     currency = models.ForeignKey('api.Currency', on_delete=models.DO_NOTHING, verbose_name='Валюта транзакции')
-    status = models.CharField(max_length=6, db_index=True, verbose_name='Статус транзакции')
+    # Pending and claimed rows are served by the partial indexes api_transaction_pending and api_transaction_claimed
+    # (see migration 0002)
+    status = models.CharField(max_length=10, choices=STATUSES, default='pending', verbose_name='Статус транзакции')
     amount = models.FloatField(verbose_name='Сумма операции')
     created = models.DateTimeField(auto_now_add=True, editable=False, verbose_name='Дата транзакции')
+    claimed = models.DateTimeField(null=True, blank=True, verbose_name='Дата начала обработки')
+    processed = models.DateTimeField(null=True, blank=True, verbose_name='Дата обработки')
 
     class Meta:
         ordering = ('pk',)
         verbose_name = 'Транзакция'
         verbose_name_plural = 'Транзакции'
+
+
+class Metric(models.Model):
+    name = models.CharField(max_length=100, verbose_name='Метрика')
+    labels = models.CharField(max_length=255, blank=True, verbose_name='Метки')
+    value = models.FloatField(default=0, verbose_name='Значение')
+
+    class Meta:
+        ordering = ('pk',)
+        verbose_name = 'Метрика'
+        verbose_name_plural = 'Метрики'
+        unique_together = ('name', 'labels')
@@ -0,0 +1,143 @@
+import re
+import logging
+import datetime
+from collections import OrderedDict
+from django.db import connection, transaction
+from django.utils import timezone
+
+# Tables partitioned by month of their date column (migration 0008), rows of months without a partition go to the
+# <table>_default partition
+PARTITIONED = OrderedDict([
+    ('api_operation', 'created'),
+    ('api_wallethistory', 'oper_date'),
+    ('api_transaction', 'created'),
+])
+# Archived partitions are moved to this schema, archive.<table> views read all of them
+ARCHIVE_SCHEMA = 'archive'
+
+
+def month_start(date):
+    return datetime.date(date.year, date.month, 1)
+
+
+def next_month(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return '{}_p{:%Y_%m}'.format(table, month)
+
+
+def _bound(month):
+    return datetime.datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+
+
+def partitions(table, schema='public'):
+    """
+    Months of the monthly partitions of a table in a schema, attached or not, in order
+    """
+    pattern = re.compile(r'^{}_p(\d{{4}})_(\d{{2}})$'.format(table))
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = %s AND tablename LIKE %s",
+                       [schema, table + '\\_p%'])
+        names = [name for name, in cursor.fetchall()]
+    return sorted(datetime.date(int(match.group(1)), int(match.group(2)), 1)
+                  for match in map(pattern.match, names) if match)
+
+
+def _attached(cursor, table):
+    cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass", [table])
+    return {name for name, in cursor.fetchall()}
+
+
+def create_partition(table, month):
+    """
+    Create the partition of a month, False if it exists. Rows of the month in the default partition are moved to it.
+    """
+    name, column = partition_name(table, month), PARTITIONED[table]
+    bounds = [_bound(month), _bound(next_month(month))]
+    with transaction.atomic(), connection.cursor() as cursor:
+        if name in _attached(cursor, table):
+            return False
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM {}_default WHERE {} >= %s AND {} < %s)'.format(
+            table, column, column), bounds)
+        if not cursor.fetchone()[0]:
+            cursor.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)'.format(name, table), bounds)
+            return True
+        # A partition cannot be attached while the default one has rows of its range
+        cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(name, table))
+        cursor.execute('WITH moved AS (DELETE FROM {0}_default WHERE {1} >= %s AND {1} < %s RETURNING *) '
+                       'INSERT INTO {2} SELECT * FROM moved'.format(table, column, name), bounds)
+        cursor.execute('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)'.format(table, name), bounds)
+    logging.warning('Partition %s: rows moved from %s_default', name, table)
+    return True
+
+
+def ensure_partitions(months_ahead, now=None):
+    """
+    Partitions of the current month and of `months_ahead` months after it for all the partitioned tables, returns
+    the names of the created ones
+    """
+    # Partitions are bounded by months in UTC
+    month = month_start((now or timezone.now()).astimezone(timezone.utc).date())
+    months = [month]
+    for _ in range(months_ahead):
+        months.append(next_month(months[-1]))
+    return [partition_name(table, month) for table in PARTITIONED for month in months
+            if create_partition(table, month)]
+
+
+def _unsettled(cursor, name):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM {} WHERE status IN ('pending', 'claimed'))".format(name))
+    return cursor.fetchone()[0]
+
+
+def _refresh_archive_view(cursor, table):
+    """
+    archive.<table>: the archived partitions of a table with the columns of the table, NULL where a partition was
+    archived before the column was added
+    """
+    cursor.execute("SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+                   "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum", [table])
+    columns = cursor.fetchall()
+    selects = []
+    for month in partitions(table, ARCHIVE_SCHEMA):
+        name = '{}.{}'.format(ARCHIVE_SCHEMA, partition_name(table, month))
+        cursor.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 "
+                       "AND NOT attisdropped", [name])
+        existing = {column for column, in cursor.fetchall()}
+        selects.append('SELECT {} FROM {}'.format(', '.join(
+            column if column in existing else 'NULL::{} AS {}'.format(column_type, column)
+            for column, column_type in columns), name))
+    cursor.execute('DROP VIEW IF EXISTS {}.{}'.format(ARCHIVE_SCHEMA, table))
+    if selects:
+        cursor.execute('CREATE VIEW {}.{} AS {}'.format(ARCHIVE_SCHEMA, table, ' UNION ALL '.join(selects)))
+
+
+def archive_partitions(before, detach_only=False):
+    """
+    Detach the partitions of the months before `before` and move them to the ARCHIVE_SCHEMA, or only detach them
+    (they stay in the public schema as plain tables) with detach_only. Transaction partitions with unsettled
+    transactions are kept. Returns the names of the archived partitions.
+    """
+    before = month_start(before)
+    archived = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        if not detach_only:
+            cursor.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(ARCHIVE_SCHEMA))
+        for table in PARTITIONED:
+            attached = _attached(cursor, table)
+            for month in partitions(table):
+                name = partition_name(table, month)
+                if month >= before or name not in attached:
+                    continue
+                if table == 'api_transaction' and _unsettled(cursor, name):
+                    logging.warning('Partition %s has unsettled transactions, not archived', name)
+                    continue
+                cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(table, name))
+                if not detach_only:
+                    cursor.execute('ALTER TABLE {} SET SCHEMA {}'.format(name, ARCHIVE_SCHEMA))
+                archived.append(name)
+            if not detach_only:
+                _refresh_archive_view(cursor, table)
+    return archived
@@ -0,0 +1,185 @@
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from django.conf import settings
+
+# Profiling is switched on at runtime by this file in the profile directory: {"every": N, "slow": seconds}
+FLAG_FILE = 'enabled.json'
+SUMMARY_SIZE = 30
+
+
+def _function(code):
+    return '{}:{}({})'.format(code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class SamplingProfiler(object):
+    """
+    Records the stack of the calling thread every `interval` seconds from a background thread. The profiled code is
+    not traced, so it runs at full speed.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread_id = None
+        self._thread = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='settlement-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_function(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def write(self, path):
+        """
+        Stacks in the collapsed format of flame graph tools, one "outer;...;inner samples" line per stack
+        """
+        with open(path, 'w') as profile_file:
+            for stack, samples in self.stacks.most_common():
+                profile_file.write('{} {}\n'.format(';'.join(stack), samples))
+
+    def summary(self):
+        total = sum(self.stacks.values()) or 1
+        own, cumulative = Counter(), Counter()
+        for stack, samples in self.stacks.items():
+            own[stack[-1]] += samples
+            for function in set(stack):
+                cumulative[function] += samples
+        lines = ['{} samples every {}s'.format(sum(self.stacks.values()), self.interval), '', '  own%   cum%  function']
+        for function, samples in cumulative.most_common(SUMMARY_SIZE):
+            lines.append('{:6.1f} {:6.1f}  {}'.format(own[function] * 100 / total, samples * 100 / total, function))
+        return '\n'.join(lines) + '\n'
+
+
+class SettlementProfiler(object):
+    """
+    Opt-in profiling of settlement runs. Every `every`-th run of a process is profiled with cProfile, other runs are
+    sampled when `slow` is set and kept if they took `slow` seconds or more. Profiles and a summary of the top
+    functions are written to `directory`, which keeps the `keep` latest runs. The FLAG_FILE in the directory
+    overrides `every` and `slow`, so a running worker is switched without a restart.
+    """
+
+    def __init__(self, directory, every, slow, keep, interval):
+        self.directory = directory
+        self.every = every
+        self.slow = slow
+        self.keep = keep
+        self.interval = interval
+        self._runs = 0
+
+    def config(self):
+        """
+        Current {"every", "slow"}, from the flag file if there is one
+        """
+        config = dict(every=self.every, slow=self.slow)
+        try:
+            with open(os.path.join(self.directory, FLAG_FILE)) as flag_file:
+                config.update(json.load(flag_file))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            logging.warning('Settlement profiler flag: %s', err)
+        return config
+
+    def enable(self, every=0, slow=0):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, FLAG_FILE), 'w') as flag_file:
+            json.dump(dict(every=every, slow=slow), flag_file)
+
+    def disable(self):
+        try:
+            os.remove(os.path.join(self.directory, FLAG_FILE))
+        except FileNotFoundError:
+            pass
+
+    def profiles(self):
+        """
+        Summary files of the kept runs, newest first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory) if name.endswith('.txt')]
+        return [os.path.join(self.directory, name) for name in sorted(names, reverse=True)]
+
+    @contextmanager
+    def run(self):
+        config = self.config()
+        self._runs += 1
+        profiler = sampler = None
+        if config['every'] and self._runs % config['every'] == 0:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif config['slow']:
+            sampler = SamplingProfiler(self.interval)
+            sampler.start()
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler:
+                profiler.disable()
+            if sampler:
+                sampler.stop()
+            try:
+                if profiler:
+                    self._save(elapsed, 'cprofile', profiler)
+                elif sampler and elapsed >= config['slow']:
+                    self._save(elapsed, 'sampled', sampler)
+            except OSError as err:
+                logging.warning('Settlement profile: %s', err)
+
+    def _save(self, elapsed, kind, profiler):
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.join(self.directory, '{}-{}-{:06d}-{}'.format(
+            time.strftime('%Y%m%d%H%M%S'), os.getpid(), self._runs, kind))
+        header = 'Settlement run {} of process {}: {:.3f}s, {}\n\n'.format(self._runs, os.getpid(), elapsed, kind)
+        if kind == 'cprofile':
+            profiler.dump_stats(name + '.prof')
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(SUMMARY_SIZE)
+            summary = stream.getvalue()
+        else:
+            profiler.write(name + '.collapsed')
+            summary = profiler.summary()
+        with open(name + '.txt', 'w') as summary_file:
+            summary_file.write(header + summary)
+        logging.info('Settlement profile %s.txt', name)
+        self._rotate()
+
+    def _rotate(self):
+        for summary in self.profiles()[self.keep:]:
+            base = summary[:-len('.txt')]
+            for extension in ('.txt', '.prof', '.collapsed'):
+                try:
+                    os.remove(base + extension)
+                except FileNotFoundError:
+                    pass
+
+
+settlement_profiler = SettlementProfiler(settings.SETTLEMENT_PROFILE_DIR, settings.SETTLEMENT_PROFILE_EVERY,
+                                         settings.SETTLEMENT_PROFILE_SLOW, settings.SETTLEMENT_PROFILE_KEEP,
+                                         settings.SETTLEMENT_PROFILE_INTERVAL)
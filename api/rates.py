@@ -0,0 +1,116 @@
+import csv
+import json
+import datetime
+from collections import OrderedDict
+from io import StringIO
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .cache import currency_registry, rate_cache
+from .db import upsert
+from .models import ExchangeRate
+
+RATE_FIELDS = ('currency', 'rate', 'created')
+# Rows per INSERT statement, 3 parameters per row stay far below the PostgreSQL limit of 65535
+LOAD_BATCH_SIZE = 5000
+
+
+class RatesError(Exception):
+    """
+    Rates that cannot be loaded, `errors` maps row numbers to the problems found in them
+    """
+
+    def __init__(self, errors):
+        super().__init__('{} invalid rows'.format(len(errors)))
+        self.errors = errors
+
+
+def read_rates(content, file_format):
+    """
+    Rows (dicts with RATE_FIELDS) of a JSON array of objects or of a CSV file with a header. Raises ValueError if
+    the content cannot be parsed.
+    """
+    if file_format == 'csv':
+        return list(csv.DictReader(StringIO(content)))
+    return json.loads(content)
+
+
+def _parse_date(value):
+    date = value if isinstance(value, datetime.datetime) else parse_datetime(value)
+    if not date:
+        for date_format in settings.DATE_INPUT_FORMATS:
+            try:
+                date = datetime.datetime.strptime(value, date_format)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError('Wrong date format.')
+    return date if timezone.is_aware(date) else timezone.make_aware(date)
+
+
+def _parse_currency(value):
+    value = str(value)
+    currency = currency_registry.get(int(value)) if value.isdigit() else currency_registry.get_by_iso(value)
+    if not currency:
+        raise ValueError('No currency with such Pk or ISO code.')
+    return currency.pk
+
+
+def validate_rates(rows):
+    """
+    Validate rows in one pass against the currency registry. Returns {(currency_id, created): rate}, the last row
+    wins for a repeated (currency, created). Raises RatesError listing every invalid row.
+    """
+    if not isinstance(rows, list):
+        raise RatesError({0: ['An array of exchange rates is expected.']})
+    rates = OrderedDict()
+    errors = {}
+    for number, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            errors[number] = ['An object with {} is expected.'.format(', '.join(RATE_FIELDS))]
+            continue
+        missing = [field for field in RATE_FIELDS if row.get(field) in (None, '')]
+        if missing:
+            errors[number] = ['{}: This field is required.'.format(field) for field in missing]
+            continue
+        row_errors = []
+        try:
+            currency_id = _parse_currency(row['currency'])
+        except ValueError as err:
+            row_errors.append('currency: {}'.format(err))
+        try:
+            rate = float(row['rate'])
+            if rate <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            row_errors.append('rate: A positive number is required.')
+        try:
+            created = _parse_date(row['created'])
+        except (TypeError, ValueError) as err:
+            row_errors.append('created: {}'.format(err))
+        if row_errors:
+            errors[number] = row_errors
+            continue
+        rates[(currency_id, created)] = rate
+    if errors:
+        raise RatesError(errors)
+    return rates
+
+
+def load_rates(rows):
+    """
+    Validate and upsert exchange rates by (currency, created): new rates are inserted, existing ones get the new
+    rate. Nothing is loaded if a row is invalid. Returns the number of rates loaded.
+    """
+    rates = validate_rates(rows)
+    items = [dict(currency_id=currency_id, created=created, rate=rate)
+             for (currency_id, created), rate in rates.items()]
+    with transaction.atomic():
+        for start in range(0, len(items), LOAD_BATCH_SIZE):
+            upsert(ExchangeRate, items[start:start + LOAD_BATCH_SIZE],
+                   conflict_fields=('currency_id', 'created'), update_fields=('rate',))
+    for currency_id in {currency_id for currency_id, _ in rates}:
+        rate_cache.invalidate(currency_id)
+    return len(items)
@@ -0,0 +1,181 @@
+import csv
+import datetime
+import binascii
+from io import StringIO
+from base64 import b64decode, b64encode
+from django.conf import settings
+from django.db.models import Q, Count, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.six.moves.urllib import parse
+from .models import WalletHistory, WalletDailyTotal
+from django.core.serializers.xml_serializer import Serializer as XMLSerializer
+from django.utils.encoding import smart_str
+
+CSV_FIELDS = [
+    'oper',
+    'type',
+    'wallet_partner',
+    'wallet_partner_name',
+    'oper_date',
+    'amount',
+    'oper__currency__currency',
+    'oper__usd_amount',
+]
+CSV_HEADERS = [
+    'Operation ID',
+    'Type of',
+    'Customer ID',
+    'Customer Name',
+    'Time',
+    'Amount of operation',
+    'Transaction Currency',
+    'USD amount'
+]
+
+
+def iter_chunks(queryset, chunk_size=None, first=None):
+    """
+    Walk a queryset ordered by pk in chunks with keyset pagination (pk > last pk of the previous chunk), so deep
+    chunks cost the same as the first one. `first` is an already fetched first chunk.
+    """
+    chunk_size = chunk_size or settings.REPORT_CHUNK_SIZE
+    chunk = first if first is not None else list(queryset.order_by('pk')[:chunk_size])
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1]
+        chunk = list(queryset.order_by('pk').filter(pk__gt=last['pk'] if isinstance(last, dict) else last.pk)
+                     [:chunk_size])
+
+
+def _drain(stream):
+    value = stream.getvalue()
+    stream.seek(0)
+    stream.truncate()
+    return value
+
+
+class StreamingXMLSerializer(XMLSerializer):
+    """
+    XML serializer that writes the document chunk by chunk: the root element is opened by the first chunk and
+    closed after the last one.
+    """
+
+    def start_serialization(self):
+        if not self.opened:
+            super().start_serialization()
+            self.opened = True
+
+    def end_serialization(self):
+        if self.closing:
+            super().end_serialization()
+
+    def stream(self, chunks):
+        stream = StringIO()
+        self.opened = self.closing = False
+        for chunk in chunks:
+            self.serialize(chunk, stream=stream)
+            yield _drain(stream)
+        self.closing = True
+        self.serialize([], stream=stream)
+        yield _drain(stream)
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def csv_stream(chunks):
+    """
+    CSV report rows, chunks are lists of WalletHistory values() dicts with CSV_FIELDS
+    """
+    writer = csv.writer(_Echo(), csv.excel)
+    yield u'\ufeff'  # BOM (optional...Excel needs it to open UTF-8 file properly)
+    yield writer.writerow([smart_str(val) for val in CSV_HEADERS])
+    for chunk in chunks:
+        yield ''.join(writer.writerow([smart_str(obj[val]) for val in CSV_FIELDS]) for obj in chunk)
+
+
+def encode_report_cursor(oper_date, pk):
+    query = parse.urlencode({'d': oper_date.isoformat(), 'i': pk})
+    return b64encode(query.encode('ascii')).decode('ascii')
+
+
+def decode_report_cursor(cursor):
+    """
+    (oper_date, pk) position of a report cursor, ValueError if the cursor is broken
+    """
+    try:
+        query = parse.parse_qs(b64decode(cursor.encode('ascii')).decode('ascii'), strict_parsing=True)
+        oper_date = parse_datetime(query['d'][0])
+        pk = int(query['i'][0])
+    except (TypeError, KeyError, UnicodeError, binascii.Error) as err:
+        raise ValueError(err)
+    if oper_date is None:
+        raise ValueError('Invalid date')
+    return oper_date, pk
+
+
+def history_page(queryset, page_size, position=None):
+    """
+    One page of wallet history ordered by (oper_date, id) after the given position and the position of the next
+    page, None on the last page. Served by the (wallet, oper_date, id) index at any depth.
+    """
+    if position:
+        oper_date, pk = position
+        queryset = queryset.filter(Q(oper_date__gt=oper_date) | Q(oper_date=oper_date, pk__gt=pk))
+    page = list(queryset.order_by('oper_date', 'pk')[:page_size + 1])
+    if len(page) <= page_size:
+        return page, None
+    last = page[page_size - 1]
+    return page[:page_size], (last.oper_date, last.pk)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time()))
+
+
+def period_totals(wallet_id, start_date=None, end_date=None):
+    """
+    Count, amount and USD amount of the wallet operations from start_date to end_date (inclusive) by operation type
+    and currency. Whole days are summed from the daily totals, only the first and the last partial days are read
+    from the wallet history.
+    """
+    days = WalletDailyTotal.objects.filter(wallet_id=wallet_id)
+    edges = []
+    first = last = None
+    if start_date:
+        first = timezone.localtime(start_date).date()
+        if _day_start(first) != start_date:
+            first += datetime.timedelta(days=1)
+            edges.append(Q(oper_date__gte=start_date, oper_date__lt=_day_start(first)))
+        days = days.filter(date__gte=first)
+    if end_date:
+        # end_date is inclusive, so its day is always partial
+        last = timezone.localtime(end_date).date()
+        edges.append(Q(oper_date__gte=_day_start(last), oper_date__lte=end_date))
+        days = days.filter(date__lt=last)
+    if first and last and first > last:
+        # The whole period is within one day
+        days = days.none()
+        edges = [Q(oper_date__gte=start_date, oper_date__lte=end_date)]
+
+    # Without the default ordering the pk is not added to GROUP BY
+    rows = list(days.order_by().values('type', 'currency_id').annotate(
+        total_count=Sum('count'), total_amount=Sum('amount'), total_usd_amount=Sum('usd_amount')))
+    for edge in edges:
+        rows += WalletHistory.objects.filter(edge, wallet_id=wallet_id).with_operation().order_by().values(
+            'type', 'oper__currency_id').annotate(total_count=Count('pk'), total_amount=Sum('amount'),
+                                                  total_usd_amount=Sum('oper__usd_amount'))
+
+    totals = {}
+    for row in rows:
+        key = (row['type'], row.get('currency_id', row.get('oper__currency_id')))
+        count, amount, usd_amount = totals.get(key, (0, 0, 0))
+        totals[key] = (count + row['total_count'], amount + row['total_amount'],
+                       usd_amount + row['total_usd_amount'])
+    return [dict(type=type_, currency_id=currency_id, count=count, amount=amount, usd_amount=usd_amount)
+            for (type_, currency_id), (count, amount, usd_amount) in sorted(totals.items())]
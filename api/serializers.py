@@ -1,6 +1,20 @@
 from django.conf import settings
 from rest_framework import serializers
-from .models import Wallet, ExchangeRate, Currency, WalletHistory
+from .cache import currency_registry, wallet_names
+from .models import Wallet, ExchangeRate, WalletHistory
+from .reports import decode_report_cursor
+
+
+class CurrencyField(serializers.CharField):
+    """
+    Currency of the object, displayed as its ISO code from the currency registry without loading the relation
+    """
+
+    def get_attribute(self, instance):
+        return instance.currency_id
+
+    def to_representation(self, value):
+        return str(currency_registry.get(value))
 
 
 class WalletSerializer(serializers.ModelSerializer):
@@ -9,21 +23,21 @@ class WalletSerializer(serializers.ModelSerializer):
     """
     balance = serializers.IntegerField(read_only=True)
     created = serializers.DateTimeField(read_only=True, format=settings.DATE_OUTPUT_FORMAT)
-    currency = serializers.CharField()
+    currency = CurrencyField()
 
     def validate_currency(self, data):
         if not data:
             raise serializers.ValidationError("This field is required.")
 
         if data.isdigit():
-            try:
-                return Currency.objects.get(pk=data)
-            except Currency.DoesNotExist:
+            currency = currency_registry.get(int(data))
+            if not currency:
                 raise serializers.ValidationError("No currency with such Pk.")
-        try:
-            return Currency.objects.get(currency=data)
-        except Currency.DoesNotExist:
+            return currency
+        currency = currency_registry.get_by_iso(data)
+        if not currency:
             raise serializers.ValidationError("No currency with such ISO code.")
+        return currency
 
     class Meta:
         model = Wallet
@@ -34,8 +48,8 @@ class ExchangeRateSerializer(serializers.ModelSerializer):
     """
     Serializer for creating, displaying currency quotes
     """
-    currency_name = serializers.CharField(source='currency.currency_name', read_only=True)
-    currency = serializers.CharField()
+    currency_name = serializers.SerializerMethodField()
+    currency = CurrencyField()
     rate = serializers.FloatField()
     created = serializers.DateTimeField(input_formats=settings.DATE_INPUT_FORMATS, format=settings.DATE_OUTPUT_FORMAT)
 
@@ -44,14 +58,17 @@ class ExchangeRateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("This field is required.")
 
         if data.isdigit():
-            try:
-                return Currency.objects.get(pk=data)
-            except Currency.DoesNotExist:
+            currency = currency_registry.get(int(data))
+            if not currency:
                 raise serializers.ValidationError("No currency with such Pk.")
-        try:
-            return Currency.objects.get(currency=data)
-        except Currency.DoesNotExist:
+            return currency
+        currency = currency_registry.get_by_iso(data)
+        if not currency:
             raise serializers.ValidationError("No currency with such ISO code.")
+        return currency
+
+    def get_currency_name(self, obj):
+        return currency_registry.get(obj.currency_id).currency_name
 
     class Meta:
         model = ExchangeRate
@@ -65,15 +82,44 @@ class ClientReportSerializer(serializers.Serializer):
     name = serializers.CharField(required=True)
     start_date = serializers.DateTimeField(input_formats=settings.DATE_INPUT_FORMATS, required=False)
     end_date = serializers.DateTimeField(input_formats=settings.DATE_INPUT_FORMATS, required=False)
+    # JSON report paging and incremental sync: rows after the cursor, rows with a greater id / a later date
+    cursor = serializers.CharField(required=False, allow_blank=True)
+    page_size = serializers.IntegerField(required=False, min_value=1)
+    since_id = serializers.IntegerField(required=False, min_value=0)
+    since = serializers.DateTimeField(input_formats=settings.DATE_INPUT_FORMATS, required=False)
+    # Period totals instead of the operations
+    summary = serializers.BooleanField(required=False)
 
     def validate_name(self, data):
         if not data:
             raise serializers.ValidationError("This field is required.")
 
-        try:
-            return Wallet.objects.get(name=data)
-        except Wallet.DoesNotExist:
+        wallet = wallet_names.get(data)
+        if not wallet:
             raise serializers.ValidationError("Wallet not exists.")
+        return wallet
+
+    def validate_cursor(self, data):
+        if not data:
+            return None
+        try:
+            return decode_report_cursor(data)
+        except ValueError:
+            raise serializers.ValidationError("Invalid cursor.")
+
+    def validate_page_size(self, data):
+        return min(data, settings.REPORT_MAX_PAGE_SIZE)
+
+
+def _get_wallets(serializer, names):
+    """
+    Wallets by name from the `wallets` dict of the serializer context (looked up beforehand for a batch), otherwise
+    from the wallet name cache
+    """
+    wallets = serializer.context.get('wallets')
+    if wallets is None:
+        return wallet_names.get_many(names)
+    return {name: wallets.get(name) for name in names}
 
 
 class WalletRefillByNameSerializer(serializers.Serializer):
@@ -87,10 +133,10 @@ class WalletRefillByNameSerializer(serializers.Serializer):
         if not data:
             raise serializers.ValidationError("This field is required.")
 
-        try:
-            return Wallet.objects.get(name=data)
-        except Wallet.DoesNotExist:
+        wallet = _get_wallets(self, [data])[data]
+        if not wallet:
             raise serializers.ValidationError("Wallet not exists.")
+        return wallet
 
 
 class WalletToWalletByNameSerializer(serializers.Serializer):
@@ -106,14 +152,9 @@ class WalletToWalletByNameSerializer(serializers.Serializer):
         if data['from_name'] == data['to_name']:
             raise serializers.ValidationError("Can't translate to yourself")
 
-        try:
-            data['wallet_from'] = Wallet.objects.get(name=data['from_name'])
-        except Wallet.DoesNotExist:
-            raise serializers.ValidationError("Wallet not exists")
-
-        try:
-            data['wallet_to'] = Wallet.objects.get(name=data['to_name'])
-        except Wallet.DoesNotExist:
+        wallets = _get_wallets(self, [data['from_name'], data['to_name']])
+        data['wallet_from'], data['wallet_to'] = wallets[data['from_name']], wallets[data['to_name']]
+        if not data['wallet_from'] or not data['wallet_to']:
             raise serializers.ValidationError("Wallet not exists")
 
         return data
@@ -130,4 +171,4 @@ class WalletHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = WalletHistory
         fields = ('id', 'oper', 'wallet_partner', 'wallet_partner_name', 'oper_date', 'amount', 'oper_currency',
-                  'usd_amount')
+                  'usd_amount', 'balance_after')
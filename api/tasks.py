@@ -1,114 +1,528 @@
 import math
+import time
+import datetime
 import logging
+from collections import OrderedDict
 from celery import shared_task
-from django.db import transaction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, OperationalError
+from django.utils import timezone
+from django.db.models import Q, Case, When, Value, IntegerField, BigIntegerField, ExpressionWrapper
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ObjectDoesNotExist
-from .models import Transaction, ExchangeRate, Operation, WalletHistory
+from django_celery_results.models import TaskResult
+from .cache import rate_cache, currency_registry
+from .db import bulk_insert, upsert
+from .metrics import metrics
+from .partitions import ensure_partitions
+from .profiling import settlement_profiler
+from .models import Transaction, Operation, WalletHistory, Wallet, WalletBalanceSnapshot, WalletDailyTotal
+
+# SQLSTATE of a transaction aborted by PostgreSQL to break a deadlock
+DEADLOCK_DETECTED = '40P01'
 
-#TODO: Mb remove Celery + rabbitmq? Need Ddos test.
 
 @shared_task
 def create_transaction(data):
     """
     Creating a replenishment transaction, transfer between accounts
     """
+    rate_cache.sync()
     with transaction.atomic():
         tran = Transaction.objects.create(**data)
         # get the last course at the time of the transaction
-        rate = ExchangeRate.objects.filter(currency=tran.currency, created__lte=tran.created).order_by('-created')\
-            .first()
+        rate = rate_cache.get_rate(tran.currency_id, tran.created)
         if not rate:
             raise ObjectDoesNotExist('Exchange rate not exists')
 
+    schedule_settlement(get_shard(tran.wallet_from_id, tran.wallet_to_id))
     return True
 
 
-def _get_wallet_amount(tran, wallet, usd, tran_amount):
-    if tran.currency == wallet.currency:
-        return tran_amount
-    rate = ExchangeRate.objects.filter(currency=wallet.currency, created__lte=tran.created).order_by(
-        '-created').first()
-    if rate:
-        return math.floor(usd * rate.rate * wallet.currency.fractional)
+def _settlement_key(shard):
+    return 'settlement-scheduled-{}'.format(shard)
 
 
-def _create_operation(tran, usd, tran_amount):
+def schedule_settlement(shard=0):
     """
-    Сreate wallet operation
+    Signal settlement of new pending transactions. Signals are coalesced: the first one schedules a settle_shard run
+    in SETTLEMENT_COALESCE_WINDOW seconds, the next ones are only counted and the run is started at once when
+    SETTLEMENT_COALESCE_SIZE transactions are waiting.
     """
-    operation = Operation.objects.create(
-        currency=tran.currency,
-        operation=tran.operation,
-        created=tran.created,
-        oper_amount=tran_amount,
-        usd_amount=usd)
-    return operation
+    key = _settlement_key(shard)
+    shards = settings.SETTLEMENT_SHARDS
+    options = dict(args=(shard, shards))
+    if shards > 1:
+        options['queue'] = settings.SETTLEMENT_QUEUE.format(shard)
+    # In a shared cache the key is deleted by the scheduled run, the timeout only guards against a lost task. A run in
+    # a worker cannot delete the key of a per-process cache, there the key expires when the run is due.
+    window = settings.SETTLEMENT_COALESCE_WINDOW
+    if cache.add(key, 1, window * 10 + 1 if settings.MEMCACHED_LOCATION else window):
+        settle_shard.apply_async(countdown=window, **options)
+        return
+    try:
+        waiting = cache.incr(key)
+    except ValueError:
+        return schedule_settlement(shard)
+    if waiting >= settings.SETTLEMENT_COALESCE_SIZE:
+        cache.delete(key)
+        settle_shard.apply_async(**options)
+
+
+def _get_wallet_amount(tran, wallet, currency, usd, tran_amount):
+    if tran.currency_id == wallet.currency_id:
+        return tran_amount
+    rate = rate_cache.get_rate(wallet.currency_id, tran.created)
+    if rate:
+        return math.floor(usd * rate * currency.fractional)
 
 
-def _create_wallet_hist(tran, wallet, wallet_partner, oper, amount):
+def _create_wallet_hist(tran, wallet, wallet_partner, amount, balance_after):
     """
-    Сreate wallet operation history
+    Сreate wallet operation history, the operation is attached after it is saved
     """
-    wallet_history = WalletHistory.objects.create(
+    return WalletHistory(
         wallet=wallet,
-        oper=oper,
+        wallet_partner=wallet_partner,
+        wallet_partner_name=wallet_partner.name if wallet_partner else None,
         oper_date=tran.created,
         type='IN' if amount > 0 else 'OUT',
-        amount=abs(amount)
+        amount=abs(amount),
+        balance_after=balance_after
     )
-    if wallet_partner:
-        wallet_history.wallet_partner = wallet_partner
-        wallet_history.wallet_partner_name = wallet_partner.name
-        wallet_history.save()
 
 
-def _inc_wallet_balance(wallet, amount):
+def _update_snapshots(histories):
     """
-    If there is not enough money in the account, we call an exception in order not to create data in the database.
+    Store the end of day balances of the wallets after the history rows, given in settlement order
     """
-    if wallet.balance + amount < 0:
-        raise Exception('Wrong amount')
-    #TODO: Test for multiple charges.
-    wallet.balance += amount
-    wallet.save()
+    closing = OrderedDict()
+    for wallet_history in histories:
+        day = timezone.localtime(wallet_history.oper_date).date()
+        closing[(wallet_history.wallet_id, day)] = wallet_history.balance_after
+    upsert(WalletBalanceSnapshot, [dict(wallet_id=wallet_id, date=day, balance=balance)
+                                   for (wallet_id, day), balance in closing.items()],
+           conflict_fields=('wallet_id', 'date'), update_fields=('balance',))
 
 
-@shared_task
-def processing_transactions():
+def _reorder_balances(histories, balances):
     """
-    Transaction processing method It is the whole logic of the transfer of money, the preservation of history
+    Keep the running balances in (oper_date, id) order. The rows of a settlement get their balances in settlement
+    order, which is the same unless a wallet already has later operations: a transaction that waited for its exchange
+    rate, or a wallet settled by two shards at once. The balances of such a wallet are then recomputed back from its
+    current balance (`balances`, the wallets are locked by the settlement) from the first row of the settlement on,
+    and so are its end of day balances.
     """
-    transactions = Transaction.objects.exclude(status__in=['start', 'done']).order_by('created')
-    counter = 0
+    starts = {}
+    for wallet_history in histories:
+        key = (wallet_history.oper_date, wallet_history.pk)
+        starts[wallet_history.wallet_id] = min(starts.get(wallet_history.wallet_id, key), key)
+    later = WalletHistory.objects.filter(wallet_id__in=starts, oper_date__gte=min(starts.values())[0]) \
+        .exclude(pk__in=[wallet_history.pk for wallet_history in histories]).values_list('wallet_id', 'oper_date', 'pk')
+    for wallet_id in {wallet_id for wallet_id, oper_date, pk in later if (oper_date, pk) > starts[wallet_id]}:
+        oper_date, pk = starts[wallet_id]
+        rows = WalletHistory.objects.filter(Q(oper_date__gt=oper_date) | Q(oper_date=oper_date, pk__gte=pk),
+                                            wallet_id=wallet_id).order_by('-oper_date', '-pk') \
+            .values_list('pk', 'oper_date', 'type', 'amount', 'balance_after')
+        balance, changed, closing = balances[wallet_id], {}, OrderedDict()
+        for pk, oper_date, type_, amount, balance_after in rows:
+            if balance_after != balance:
+                changed[pk] = balance
+            closing.setdefault(timezone.localtime(oper_date).date(), balance)
+            balance -= amount if type_ == 'IN' else -amount
+        if changed:
+            WalletHistory.objects.filter(wallet_id=wallet_id, pk__in=changed, oper_date__gte=starts[wallet_id][0]) \
+                .update(balance_after=Case(*[When(pk=pk, then=Value(balance)) for pk, balance in changed.items()],
+                                           output_field=BigIntegerField()))
+        upsert(WalletBalanceSnapshot, [dict(wallet_id=wallet_id, date=day, balance=balance)
+                                       for day, balance in reversed(closing.items())],
+               conflict_fields=('wallet_id', 'date'), update_fields=('balance',))
+
+
+def _update_totals(histories):
+    """
+    Add the history rows to the daily totals of their wallets, the operation of every row must be attached
+    """
+    totals = OrderedDict()
+    for wallet_history in histories:
+        key = (wallet_history.wallet_id, timezone.localtime(wallet_history.oper_date).date(), wallet_history.type,
+               wallet_history.oper.currency_id)
+        count, amount, usd_amount = totals.get(key, (0, 0, 0))
+        totals[key] = (count + 1, amount + wallet_history.amount, usd_amount + wallet_history.oper.usd_amount)
+    upsert(WalletDailyTotal, [dict(wallet_id=wallet_id, date=day, type=type_, currency_id=currency_id, count=count,
+                                   amount=amount, usd_amount=usd_amount)
+                              for (wallet_id, day, type_, currency_id), (count, amount, usd_amount) in totals.items()],
+           conflict_fields=('wallet_id', 'date', 'type', 'currency_id'),
+           increment_fields=('count', 'amount', 'usd_amount'))
+
+
+class BalanceConflict(Exception):
+    """
+    A wallet of the batch was changed by another settler after it was read
+    """
+
+
+class Overdraft(Exception):
+    """
+    Not enough money in the account
+    """
+
+    def __init__(self):
+        super().__init__('Wrong amount')
+
+
+def _prepare(tran, wallets, currencies):
+    """
+    Amounts of a transaction: USD amount, amount in the transaction currency and the wallet legs
+    (wallet, partner, amount). None if there is no exchange rate yet, for the transaction or for a wallet currency.
+    """
+    rate = rate_cache.get_rate(tran.currency_id, tran.created)
+    if not rate:
+        return None
+
+    usd = math.floor(100 * tran.amount / rate)
+    tran_amount = math.floor(tran.amount * currencies[tran.currency_id].fractional)
 
-    for tran in transactions.iterator():
+    wallet_to = wallets[tran.wallet_to_id]
+    wallet_from = wallets[tran.wallet_from_id] if tran.operation == 'TRANSFER' else None
+    sides = [(wallet_from, wallet_to, -1)] if wallet_from else []
+    sides.append((wallet_to, wallet_from, 1))
+    legs = []
+    for wallet, partner, sign in sides:
+        amount = _get_wallet_amount(tran, wallet, currencies[wallet.currency_id], usd, tran_amount)
+        if amount is None:
+            return None
+        legs.append((wallet, partner, sign * amount))
+    return usd, tran_amount, legs
+
+
+def _create_operation(tran, usd, tran_amount):
+    return Operation(currency_id=tran.currency_id, operation=tran.operation, created=tran.created,
+                     oper_amount=tran_amount, usd_amount=usd)
+
+
+def _load_wallets(transactions, lock=False):
+    """
+    Wallets of the transactions by pk. With lock they are locked with SELECT FOR UPDATE in pk order, the order every
+    settler locks wallets in, so settlers that need the same wallets wait for each other instead of deadlocking.
+    """
+    wallet_ids = {tran.wallet_to_id for tran in transactions} | \
+        {tran.wallet_from_id for tran in transactions if tran.wallet_from_id}
+    wallets = Wallet.objects.filter(pk__in=wallet_ids).order_by('pk')
+    if lock:
+        wallets = wallets.select_for_update()
+    return {wallet.pk: wallet for wallet in wallets}
+
+
+def _retry_deadlocks(func, *args):
+    """
+    Run func in a transaction, again up to SETTLEMENT_DEADLOCK_RETRIES times if PostgreSQL aborts it to break
+    a deadlock
+    """
+    for attempt in range(settings.SETTLEMENT_DEADLOCK_RETRIES + 1):
         try:
             with transaction.atomic():
-                rate = ExchangeRate.objects.filter(currency=tran.currency, created__lte=tran.created)\
-                    .order_by('-created').first()
-                if not rate:
+                return func(*args)
+        except OperationalError as err:
+            if getattr(err.__cause__, 'pgcode', None) != DEADLOCK_DETECTED or \
+                    attempt == settings.SETTLEMENT_DEADLOCK_RETRIES:
+                raise
+            logging.info('Deadlock, retrying: %s', err)
+            metrics.inc('payment_settlement_failures_total', reason='deadlock')
+
+
+def _rows(transactions):
+    """
+    Rows of the given transactions, bounded by their dates so that only their partitions of the table are read
+    """
+    if not transactions:
+        return Transaction.objects.none()
+    dates = [tran.created for tran in transactions]
+    return Transaction.objects.filter(pk__in=[tran.pk for tran in transactions],
+                                      created__range=(min(dates), max(dates)))
+
+
+def settle_batch(transactions):
+    """
+    Settle a batch of claimed transactions. Amounts and balances are computed in memory, operations, history and
+    balances are written with a fixed number of queries. A transaction that cannot be settled (not enough money in
+    the account) fails without affecting the rest of the batch, one without an exchange rate goes back to pending.
+    Must run in a transaction: the wallets are locked in pk order for it. If a wallet changes anyway while the batch
+    is computed, BalanceConflict is raised.
+    """
+    currencies = currency_registry.by_pk()
+    wallets = _load_wallets(transactions, lock=True)
+    balances = {pk: wallet.balance for pk, wallet in wallets.items()}
+
+    settled, failed, retry, reasons = [], [], [], []
+    with metrics.timer('payment_settlement_stage_seconds', stage='rate_lookup'):
+        for tran in transactions:
+            try:
+                prepared = _prepare(tran, wallets, currencies)
+                if not prepared:
+                    retry.append(tran)
                     continue
-    
-                usd = math.floor(100 * tran.amount / rate.rate)
-                tran_amount = math.floor(tran.amount * tran.currency.fractional)
-                oper = _create_operation(tran, usd, tran_amount)
-    
-                wallet_to = tran.wallet_to
-                wallet_from = None
-    
-                if tran.operation == 'TRANSFER':
-                    wallet_from = tran.wallet_from
-                    wallet_from_amount = -1 * _get_wallet_amount(tran, wallet_from, usd, tran_amount)
-                    _create_wallet_hist(tran, wallet_from, wallet_to, oper, wallet_from_amount)
-                    _inc_wallet_balance(wallet_from, wallet_from_amount)
-    
-                wallet_to_amount = _get_wallet_amount(tran, wallet_to, usd, tran_amount)
-                _create_wallet_hist(tran, wallet_to, wallet_from, oper, wallet_to_amount)
-                _inc_wallet_balance(wallet_to, wallet_to_amount)
-    
-                tran.status = 'done'
-                tran.save()
-                counter += 1
-        except Exception as err:
-            logging.warning(err)
-    return '{} transactions processed'.format(counter)
+                usd, tran_amount, legs = prepared
+
+                # If there is not enough money in the account, the transaction fails.
+                for wallet, _, amount in legs:
+                    if balances[wallet.pk] + amount < 0:
+                        raise Overdraft()
+            except Exception as err:
+                logging.warning('Transaction %s: %s', tran.pk, err)
+                reasons.append('overdraft' if isinstance(err, Overdraft) else 'error')
+                failed.append(tran)
+                continue
+
+            for wallet, _, amount in legs:
+                balances[wallet.pk] += amount
+            settled.append((tran, _create_operation(tran, usd, tran_amount), legs))
+
+    deltas = {}
+    for _, _, legs in settled:
+        for wallet, _, amount in legs:
+            deltas[wallet.pk] = deltas.get(wallet.pk, 0) + amount
+    # Balances go first: nothing else is written if a wallet was changed in the meantime.
+    with metrics.timer('payment_settlement_stage_seconds', stage='balance_update'):
+        if not Wallet.objects.inc_balances(deltas, {pk: wallet.version for pk, wallet in wallets.items()}):
+            raise BalanceConflict('Wallet balances changed during settlement')
+
+    now = timezone.now()
+    with metrics.timer('payment_settlement_stage_seconds', stage='status_update'):
+        _rows(retry).update(status='pending', claimed=None)
+        _rows(failed).update(status='failed', processed=now)
+
+    if settled:
+        with metrics.timer('payment_settlement_stage_seconds', stage='history_write'):
+            bulk_insert(Operation, [oper for _, oper, _ in settled])
+            histories = []
+            # Running balances are replayed in settlement order from the balances the batch started with
+            running = {pk: wallet.balance for pk, wallet in wallets.items()}
+            for tran, oper, legs in settled:
+                for wallet, wallet_partner, amount in legs:
+                    running[wallet.pk] += amount
+                    wallet_history = _create_wallet_hist(tran, wallet, wallet_partner, amount, running[wallet.pk])
+                    wallet_history.oper = oper
+                    histories.append(wallet_history)
+            bulk_insert(WalletHistory, histories)
+            _update_snapshots(histories)
+            _reorder_balances(histories, running)
+            _update_totals(histories)
+        with metrics.timer('payment_settlement_stage_seconds', stage='status_update'):
+            _rows([tran for tran, _, _ in settled]).update(status='done', processed=now)
+
+    # Counted once everything is written: a batch that raises is retried or settled row by row and counted there
+    for reason in reasons:
+        metrics.inc('payment_settlement_failures_total', reason=reason)
+    if retry:
+        metrics.inc('payment_settlement_failures_total', len(retry), reason='no_rate')
+    if failed:
+        metrics.inc('payment_settlement_transactions_total', len(failed), result='failed')
+    if settled:
+        metrics.inc('payment_settlement_transactions_total', len(settled), result='done')
+    return len(settled)
+
+
+def _settle_one(tran, wallets, currencies):
+    """
+    Write the balances, operation and history of one transaction, False if there is no exchange rate yet
+    """
+    prepared = _prepare(tran, wallets, currencies)
+    if not prepared:
+        return False
+    usd, tran_amount, legs = prepared
+
+    # Wallets are updated in pk order, so concurrent settlers lock them in the same order.
+    for wallet, _, amount in sorted(legs, key=lambda leg: leg[0].pk):
+        if not Wallet.objects.inc_balance(wallet.pk, amount):
+            raise Overdraft()
+
+    oper = _create_operation(tran, usd, tran_amount)
+    oper.save()
+    # The updated wallets are locked by this transaction, their balances are the running balances
+    balances = dict(Wallet.objects.filter(pk__in=[wallet.pk for wallet, _, _ in legs])
+                    .values_list('pk', 'balance'))
+    histories = [_create_wallet_hist(tran, wallet, wallet_partner, amount, balances[wallet.pk])
+                 for wallet, wallet_partner, amount in legs]
+    for wallet_history in histories:
+        wallet_history.oper = oper
+    bulk_insert(WalletHistory, histories)
+    _update_snapshots(histories)
+    _reorder_balances(histories, balances)
+    _update_totals(histories)
+    return True
+
+
+def settle_transaction(tran, wallets, currencies):
+    """
+    Settle one claimed transaction with conditional balance updates, without reading the wallet balances.
+    Returns True if the transaction is done.
+    """
+    status = 'failed'
+    try:
+        if not _retry_deadlocks(_settle_one, tran, wallets, currencies):
+            _rows([tran]).update(status='pending', claimed=None)
+            metrics.inc('payment_settlement_failures_total', reason='no_rate')
+            return False
+        status = 'done'
+    except Exception as err:
+        logging.warning('Transaction %s: %s', tran.pk, err)
+        metrics.inc('payment_settlement_failures_total', reason='overdraft' if isinstance(err, Overdraft) else 'error')
+
+    _rows([tran]).update(status=status, processed=timezone.now())
+    metrics.inc('payment_settlement_transactions_total', result=status)
+    return status == 'done'
+
+
+def get_shard(wallet_from_id, wallet_to_id, shards=None):
+    """
+    Settlement shard of a transaction. A wallet belongs to the shard pk % shards, transactions are routed by the
+    wallet they take money from, so all debits of a wallet are settled by one shard in order. Only the transactions
+    with both wallets in the shard are settled in its batches (see is_cross_shard).
+    """
+    shards = shards or settings.SETTLEMENT_SHARDS
+    return (wallet_from_id or wallet_to_id) % shards
+
+
+def is_cross_shard(tran, shards):
+    """
+    A transfer to a wallet of another shard. It is settled on the locked row by row path, so the batches of a shard
+    change only the wallets of the shard and never conflict with the batches of other shards.
+    """
+    return bool(tran.wallet_from_id) and tran.wallet_from_id % shards != tran.wallet_to_id % shards
+
+
+def _pending_transactions(shard=None, shards=None):
+    transactions = Transaction.objects.filter(status='pending')
+    shards = shards or settings.SETTLEMENT_SHARDS
+    if shard is not None and shards > 1:
+        # Same routing as get_shard, computed by the database
+        transactions = transactions.annotate(shard=ExpressionWrapper(
+            Coalesce('wallet_from', 'wallet_to') % shards, output_field=IntegerField())).filter(shard=shard)
+    return transactions.order_by('created', 'pk')
+
+
+def claim_transactions(transactions, batch_size):
+    """
+    Claim up to batch_size pending transactions. Rows locked by another settler are skipped, so concurrent settlers
+    grab disjoint batches without waiting for each other.
+    """
+    with transaction.atomic():
+        batch = list(transactions.select_for_update(skip_locked=True)[:batch_size])
+        _rows(batch).update(status='claimed', claimed=timezone.now())
+    return batch
+
+
+def release_stale_claims():
+    """
+    Return to pending the transactions claimed by a settler that died before finishing them
+    """
+    expired = timezone.now() - datetime.timedelta(seconds=settings.SETTLEMENT_CLAIM_TIMEOUT)
+    return Transaction.objects.filter(status='claimed', claimed__lt=expired).update(status='pending', claimed=None)
+
+
+def _settle_pending(transactions, batch_size=None, shards=1):
+    """
+    Settle pending transactions in batches of SETTLEMENT_BATCH_SIZE, returns the result of the run. The cross-shard
+    transfers of a batch are settled one by one after it.
+    """
+    batch_size = batch_size or settings.SETTLEMENT_BATCH_SIZE
+    counter = 0
+    started = time.time()
+
+    with settlement_profiler.run():
+        # Pending transactions are recent: the batches read only the partitions from the oldest pending one on
+        oldest = transactions.values_list('created', flat=True).first()
+        if oldest:
+            transactions = transactions.filter(created__gte=oldest)
+        # Transactions without an exchange rate go back to pending, so the batches are walked by (created, pk) keyset.
+        last = None
+        while True:
+            batch_qs = transactions
+            if last:
+                batch_qs = batch_qs.filter(Q(created__gt=last.created) | Q(created=last.created, pk__gt=last.pk))
+            batch = claim_transactions(batch_qs, batch_size)
+            if batch:
+                rate_cache.sync()
+                local = [tran for tran in batch if not is_cross_shard(tran, shards)]
+                cross = [tran for tran in batch if is_cross_shard(tran, shards)]
+                try:
+                    counter += _retry_deadlocks(settle_batch, local)
+                except BalanceConflict as err:
+                    logging.info(err)
+                    metrics.inc('payment_settlement_failures_total', reason='balance_conflict')
+                    # Fall back to settling the batch row by row with conditional updates.
+                    cross = local + cross
+                except Exception as err:
+                    logging.warning(err)
+                    metrics.inc('payment_settlement_failures_total', reason='batch_error')
+                    _rows(local).update(status='pending', claimed=None)
+                if cross:
+                    wallets, currencies = _load_wallets(cross), currency_registry.by_pk()
+                    counter += sum(settle_transaction(tran, wallets, currencies) for tran in cross)
+            if len(batch) < batch_size:
+                break
+            last = batch[-1]
+
+    elapsed = time.time() - started
+    metrics.observe('payment_settlement_run_seconds', elapsed)
+    # The work of the run is committed, a failed flush only keeps the values for the next one
+    metrics.flush()
+    result = '{} transactions processed in {:.3f}s ({:.1f} tx/s), exchange rate cache: {hits} hits, {misses} misses'\
+        .format(counter, elapsed, counter / elapsed if elapsed else 0, **rate_cache.stats())
+    logging.info(result)
+    return result
+
+
+@shared_task(ignore_result=False)
+def settle_shard(shard, shards=None, batch_size=None):
+    """
+    Settle the pending transactions of one shard, runs on the shard queue
+    """
+    cache.delete(_settlement_key(shard))
+    return _settle_pending(_pending_transactions(shard, shards), batch_size, shards or settings.SETTLEMENT_SHARDS)
+
+
+@shared_task(ignore_result=False)
+def processing_transactions(batch_size=None):
+    """
+    Transaction processing method It is the whole logic of the transfer of money, the preservation of history.
+    With SETTLEMENT_SHARDS > 1 the work is fanned out to the shard queues, one settle_shard task per shard.
+    """
+    release_stale_claims()
+    shards = settings.SETTLEMENT_SHARDS
+    if shards <= 1:
+        return _settle_pending(_pending_transactions(), batch_size)
+
+    for shard in range(shards):
+        settle_shard.apply_async(args=(shard, shards, batch_size), queue=settings.SETTLEMENT_QUEUE.format(shard))
+    return '{} settlement shards scheduled'.format(shards)
+
+
+@shared_task
+def create_partitions():
+    """
+    Create the monthly partitions of the next PARTITION_MONTHS_AHEAD months
+    """
+    created = ensure_partitions(settings.PARTITION_MONTHS_AHEAD)
+    return '{} partitions created'.format(len(created))
+
+
+@shared_task
+def prune_task_results(batch_size=None):
+    """
+    Delete the stored task results older than CELERY_RESULT_EXPIRES seconds. Rows are deleted oldest first in batches
+    of TASK_RESULT_PRUNE_BATCH_SIZE, each in its own transaction, so a large backlog does not hold locks for long.
+    """
+    batch_size = batch_size or settings.TASK_RESULT_PRUNE_BATCH_SIZE
+    expired = timezone.now() - datetime.timedelta(seconds=settings.CELERY_RESULT_EXPIRES)
+    deleted = 0
+    while True:
+        batch = list(TaskResult.objects.filter(date_done__lt=expired).order_by('pk')
+                     .values_list('pk', flat=True)[:batch_size])
+        if batch:
+            deleted += TaskResult.objects.filter(pk__in=batch).delete()[0]
+        if len(batch) < batch_size:
+            break
+    return '{} task results deleted'.format(deleted)
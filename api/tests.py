@@ -1,7 +1,44 @@
+import io
+import os
+import time
+import csv
+import gzip
+import json
+import asyncio
+import tempfile
+import datetime
+from xml.dom import minidom
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from django.core.urlresolvers import reverse
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection, DatabaseError, IntegrityError, OperationalError
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APITestCase
 from rest_framework import status
-from .models import Wallet, WalletHistory
+from django_celery_results.models import TaskResult
+from payment_system.db_pool.base import DatabaseWrapper
+from payment_system.db_pool.pool import PoolTimeout
+from payment_system.routers import ReplicaRouter, read_only, replica_lag
+from payment_system.wsgi.metrics import metrics as metrics_app
+from .models import Currency, Wallet, WalletHistory, WalletBalanceSnapshot, Transaction, Operation, ExchangeRate, \
+    Metric
+from .cache import ExchangeRateCache, rate_cache, currency_registry
+from .db import bulk_insert
+from .reports import period_totals
+from .ingestion import TransactionBuffer, transaction_buffer
+from .management.commands.loadtest import percentile
+from .metrics import metrics
+from .partitions import PARTITIONED, month_start, partition_name, partitions, create_partition, ensure_partitions, \
+    archive_partitions
+from .profiling import settlement_profiler
+from .tasks import processing_transactions, settle_shard, settle_batch, settle_transaction, get_shard, \
+    create_transaction, prune_task_results
 
 
 class TestApiView(APITestCase):
@@ -53,6 +90,16 @@ class TestApiView(APITestCase):
             response = self.client.post(url, data={'amount': 1, 'currency_use': 'BAD PARAM'})
             self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_ingestion(self):
+        cache.clear()
+        wallet = Wallet.objects.get(name='Aarav')
+        response = self.client.post('/api/wallet_refill_by_name/Aarav', data={'amount': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Tests run Celery eagerly, so the transaction is created and settled by the time the response is returned
+        tran = Transaction.objects.filter(wallet_to=wallet).latest('pk')
+        self.assertEqual((tran.operation, tran.amount, tran.status), ('REFILL', 10, 'done'))
+        self.assertGreater(Wallet.objects.get(pk=wallet.pk).balance, wallet.balance)
+
     def test_create_exchange_rate(self):
         url = '/api/exchange_rate'
 
@@ -92,3 +139,909 @@ class TestApiView(APITestCase):
             response = self.client.get(url + '&export_file_type=csv')
             csv_filename = 'attachment; filename="Report for {}.csv"'.format(wallet_history.wallet.name)
             self.assertEqual(response['content-disposition'], csv_filename)
+
+    def test_client_report_streaming(self):
+        url = '/api/client_report?name=Aarav&export_file_type={}'
+        with self.settings(REPORT_CHUNK_SIZE=2):
+            response = self.client.get(url.format('csv'))
+            self.assertTrue(response.streaming)
+            rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf8'))))
+            self.assertEqual(len(rows), 1 + WalletHistory.objects.filter(wallet__name='Aarav').count())
+
+            response = self.client.get(url.format('xml'), HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            document = minidom.parseString(gzip.decompress(b''.join(response.streaming_content)))
+            self.assertEqual(len(document.getElementsByTagName('object')),
+                             WalletHistory.objects.filter(wallet__name='Aarav').count())
+
+        response = self.client.get('/api/client_report?name=Abdiel&export_file_type=csv')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_client_report_paging(self):
+        url = '/api/client_report'
+        history = list(WalletHistory.objects.filter(wallet__name='Aarav').order_by('oper_date', 'pk')
+                       .values_list('pk', flat=True))
+
+        response = self.client.get(url, {'name': 'Aarav', 'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [row['id'] for row in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(url, {'name': 'Aarav', 'page_size': 2, 'cursor': response.data['next']})
+            ids += [row['id'] for row in response.data['results']]
+        self.assertEqual(ids, history)
+
+        response = self.client.get(url, {'name': 'Aarav', 'since_id': history[-1]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+        response = self.client.get(url, {'name': 'Aarav', 'since_id': history[-2]})
+        self.assertEqual([row['id'] for row in response.data['results']], history[-1:])
+
+        with self.settings(REPORT_MAX_PAGE_SIZE=3):
+            response = self.client.get(url, {'name': 'Aarav', 'page_size': 100})
+            self.assertEqual(response.data['page_size'], 3)
+            # Without paging parameters the report is the whole list
+            response = self.client.get(url, {'name': 'Aarav'})
+            self.assertEqual([row['id'] for row in response.data], history)
+
+        response = self.client.get(url, {'name': 'Aarav', 'cursor': 'bad'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_wallet_name_cache(self):
+        cache.clear()
+        url = '/api/wallet2wallet_by_name/Aarav/Aaden'
+        with mock.patch('api.views.ingest_transaction') as ingest:
+            self.client.post(url, data={'amount': 10, 'currency_use': 'FROM'})
+            # Both names are resolved from the cache, the view does not read the database at all
+            with self.assertNumQueries(0):
+                response = self.client.post(url, data={'amount': 10, 'currency_use': 'TO'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        aarav, aaden = Wallet.objects.get(name='Aarav'), Wallet.objects.get(name='Aaden')
+        self.assertEqual(ingest.call_args[0][0]['currency_id'], aaden.currency_id)
+        self.assertEqual(ingest.call_args[0][0]['wallet_from_id'], aarav.pk)
+
+        # Unknown names are cached too, until the wallet is created
+        response = self.client.post('/api/wallet_refill_by_name/Newcomer', data={'amount': 10})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.post('/api/client', data={'name': 'Newcomer', 'city': 'Moscow', 'country': 'Russia',
+                                              'currency': aarav.currency_id})
+        with mock.patch('api.views.ingest_transaction'):
+            response = self.client.post('/api/wallet_refill_by_name/Newcomer', data={'amount': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_transaction_batch(self):
+        cache.clear()
+        items = [
+            {'operation': 'REFILL', 'name': 'Aarav', 'amount': 10},
+            {'operation': 'TRANSFER', 'from_name': 'Aarav', 'to_name': 'Aaden', 'currency_use': 'TO', 'amount': 1},
+            {'operation': 'REFILL', 'name': 'Nobody', 'amount': 10},
+            {'operation': 'TRANSFER', 'from_name': 'Aarav', 'to_name': 'Aarav', 'currency_use': 'TO', 'amount': 1},
+            {'operation': 'REFILL', 'name': 'Aaden', 'amount': 'ten'},
+            {'operation': 'WITHDRAW'},
+            {'operation': 'REFILL', 'name': ['Aarav'], 'amount': 1},
+        ] + [{'operation': 'REFILL', 'name': 'Abdiel', 'amount': 1}] * 100
+        with mock.patch('api.ingestion.schedule_settlement') as schedule, \
+                mock.patch('api.ingestion.bulk_insert', wraps=bulk_insert) as insert:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/transactions/batch', data=items, format='json')
+        # One lookup of all the wallet names and one bulk insert for the whole batch
+        self.assertEqual(sum('FROM "api_wallet"' in query['sql'] for query in queries), 1)
+        self.assertEqual(insert.call_count, 1)
+        self.assertEqual(len(insert.call_args[0][1]), 102)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['accepted'], response.data['rejected']), (102, 5))
+        self.assertEqual(schedule.call_count, 1)
+
+        results = response.data['items']
+        self.assertEqual([result['result'] for result in results[:7]], ['accepted', 'accepted'] + ['rejected'] * 5)
+        self.assertEqual(results[2]['errors'], {'name': ['Wallet not exists.']})
+        # Same errors as the by-name endpoints
+        self.assertEqual(results[3]['errors'], {'non_field_errors': ["Can't translate to yourself"]})
+        self.assertIn('amount', results[4]['errors'])
+        self.assertEqual(results[6]['errors'], {'name': ['Not a valid string.']})
+        transfer = Transaction.objects.get(pk=results[1]['id'])
+        self.assertEqual(transfer.currency_id, Wallet.objects.get(name='Aaden').currency_id)
+        self.assertEqual(transfer.status, 'pending')
+        self.assertEqual(Transaction.objects.filter(wallet_to__name='Abdiel', status='pending').count(), 100)
+
+        response = self.client.post('/api/transactions/batch', data={'name': 'Aarav'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cursor_pagination(self):
+        response = self.client.get('/api/client', {'cursor': '', 'page_size': 30, 'count': 'exact'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], Wallet.objects.count())
+        self.assertIsNone(response.data['previous'])
+        first_page = [wallet['id'] for wallet in response.data['results']]
+        self.assertEqual(first_page, list(Wallet.objects.order_by('pk').values_list('pk', flat=True)[:30]))
+
+        response = self.client.get('/api/client', {'cursor': response.data['next'], 'page_size': 30, 'count': 'exact'})
+        self.assertEqual(response.data['results'][0]['id'], Wallet.objects.order_by('pk')[30].pk)
+        self.assertEqual(response.data['count'], Wallet.objects.count())
+
+        response = self.client.get('/api/client', {'cursor': response.data['previous'], 'page_size': 30})
+        self.assertEqual([wallet['id'] for wallet in response.data['results']], first_page)
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get('/api/exchange_rate', {'cursor': 'bad'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(TRANSACTION_INGESTION_MODE='direct')
+class TestApiViewDirectIngestion(TestApiView):
+    """
+    The API tests with transactions inserted by the web process
+    """
+
+
+@override_settings(TRANSACTION_INGESTION_MODE='buffered')
+class TestApiViewBufferedIngestion(TestApiView):
+    """
+    The API tests with transactions written by the transaction buffer, at once so that the test transaction sees them
+    """
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(transaction_buffer, 'interval', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_background_flush(self):
+        buffer = TransactionBuffer(interval=60, size=3)
+        written = []
+        with mock.patch.object(buffer, '_write', side_effect=written.append):
+            buffer.append({'pk': 1})
+            buffer.append({'pk': 2})
+            self.assertEqual(written, [])
+            # The third transaction fills the buffer and wakes the writer up
+            buffer.append({'pk': 3})
+            for _ in range(100):
+                if written:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(written, [[{'pk': 1}, {'pk': 2}, {'pk': 3}]])
+            buffer.append({'pk': 4})
+            self.assertEqual(buffer.flush(), 1)
+
+    def test_write_failures(self):
+        buffer = TransactionBuffer(interval=60, size=100)
+        data = dict(wallet_to_id=4, currency_id=Wallet.objects.get(pk=4).currency_id, operation='REFILL')
+        for amount in (1, 2, 3):
+            buffer.append(dict(data, amount=amount))
+        # A failed write keeps the transactions in the buffer
+        with mock.patch('api.ingestion.bulk_insert', side_effect=OperationalError('connection lost')):
+            with self.assertRaises(OperationalError):
+                buffer.flush()
+
+        def insert(model, objs):
+            if len(objs) > 1 or objs[0].amount == 2:
+                raise IntegrityError('rejected')
+            return bulk_insert(model, objs)
+
+        # Only the transactions rejected by the database or without an exchange rate are dropped
+        rub = Currency.objects.create(currency_name='Russian ruble', currency='RUB', fractional=100)
+        buffer.append(dict(data, currency_id=rub.pk, amount=4))
+        existing = Transaction.objects.count()
+        with mock.patch('api.ingestion.bulk_insert', side_effect=insert), self.assertLogs(level='ERROR') as logs:
+            self.assertEqual(buffer.flush(), 4)
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(sorted(Transaction.objects.order_by('-pk').values_list('amount', flat=True)[:2]), [1, 3])
+        self.assertEqual(Transaction.objects.count(), existing + 2)
+
+
+class TestSettlement(TestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        rate_cache.invalidate()
+        cache.clear()
+
+    def _create(self, **data):
+        return Transaction.objects.create(**data)
+
+    def test_batch_settlement(self):
+        wallet_from, wallet_to = Wallet.objects.get(pk=2), Wallet.objects.get(pk=3)
+        refill = self._create(wallet_to=wallet_to, currency=wallet_to.currency, amount=10, operation='REFILL')
+        transfer = self._create(wallet_from=wallet_from, wallet_to=wallet_to, currency=wallet_from.currency,
+                                amount=1, operation='TRANSFER')
+        # Overdraft must reject only its own transaction
+        overdraft = self._create(wallet_from=wallet_from, wallet_to=wallet_to, currency=wallet_from.currency,
+                                 amount=wallet_from.balance, operation='TRANSFER')
+
+        result = processing_transactions(batch_size=2)
+        self.assertTrue(result.startswith('2 transactions processed'), result)
+
+        self.assertEqual(Transaction.objects.get(pk=refill.pk).status, 'done')
+        self.assertEqual(Transaction.objects.get(pk=transfer.pk).status, 'done')
+        self.assertEqual(Transaction.objects.get(pk=overdraft.pk).status, 'failed')
+
+        self.assertEqual(Wallet.objects.get(pk=2).balance, wallet_from.balance - 100)
+        self.assertEqual(WalletHistory.objects.filter(wallet=wallet_from, oper__created=transfer.created).count(), 1)
+        self.assertEqual(WalletHistory.objects.filter(wallet=wallet_to, type='IN').count(), 2)
+        self.assertEqual(Operation.objects.filter(created__in=[refill.created, transfer.created]).count(), 2)
+        self.assertGreater(Wallet.objects.get(pk=3).balance, wallet_to.balance + 1000)
+
+    def test_task_results(self):
+        # Only the settlement runs store their results
+        self.assertTrue(create_transaction.ignore_result)
+        self.assertFalse(processing_transactions.ignore_result)
+        self.assertFalse(settle_shard.ignore_result)
+
+        for number in range(4):
+            TaskResult.objects.create(task_id='task-{}'.format(number), status='SUCCESS')
+        expired = timezone.now() - datetime.timedelta(seconds=settings.CELERY_RESULT_EXPIRES + 1)
+        TaskResult.objects.exclude(task_id='task-3').update(date_done=expired)
+        self.assertEqual(prune_task_results(batch_size=2), '3 task results deleted')
+        self.assertEqual(list(TaskResult.objects.values_list('task_id', flat=True)), ['task-3'])
+
+    def test_profiling(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.multiple(settlement_profiler, directory=directory, keep=2, interval=0.001):
+            call_command('profile_settlement', 'on', every=2, stdout=io.StringIO())
+            for _ in range(4):
+                processing_transactions()
+            profiles = settlement_profiler.profiles()
+            self.assertEqual(len(profiles), 2)
+            self.assertTrue(os.path.exists(profiles[0][:-len('.txt')] + '.prof'))
+            with open(profiles[0]) as summary:
+                self.assertIn('claim_transactions', summary.read())
+
+            # Runs slower than the threshold are kept from the sampling profiler
+            call_command('profile_settlement', 'on', slow=0.02, stdout=io.StringIO())
+            with settlement_profiler.run():
+                pass
+            with settlement_profiler.run():
+                time.sleep(0.05)
+            sampled = [summary for summary in settlement_profiler.profiles() if summary.endswith('-sampled.txt')]
+            self.assertEqual(len(sampled), 1)
+            with open(sampled[0]) as summary:
+                self.assertIn('test_profiling', summary.read())
+
+            output = io.StringIO()
+            call_command('profile_settlement', 'off', stdout=output)
+            self.assertIn('every 0 run(s), slower than 0', output.getvalue())
+
+    def test_running_balances(self):
+        wallet, partner = Wallet.objects.get(pk=3), Wallet.objects.get(pk=4)
+        for amount in (10, 20):
+            self._create(wallet_to=wallet, currency=wallet.currency, amount=amount, operation='REFILL')
+        self._create(wallet_from=wallet, wallet_to=partner, currency=wallet.currency, amount=5, operation='TRANSFER')
+        processing_transactions()
+
+        start, wallet = wallet.balance, Wallet.objects.get(pk=3)
+        history = list(WalletHistory.objects.filter(wallet=wallet).order_by('oper_date', 'pk'))
+        self.assertEqual([row.balance_after - start for row in history], [1000, 3000, 2500])
+        self.assertEqual(history[-1].balance_after, wallet.balance)
+        self.assertEqual(WalletBalanceSnapshot.objects.get(wallet=wallet).balance, wallet.balance)
+        self.assertEqual(WalletHistory.objects.balance_at(wallet.pk, history[1].oper_date), start + 3000)
+        self.assertEqual(WalletHistory.objects.balance_at(wallet.pk, history[1].oper_date, inclusive=False),
+                         start + 1000)
+
+        oper_date = timezone.localtime(history[1].oper_date).strftime('%Y-%m-%d %H:%M:%S.%f')
+        response = self.client.get('/api/client_report', {
+            'name': wallet.name, 'page_size': 1, 'start_date': oper_date, 'end_date': oper_date})
+        self.assertEqual(response.json()['opening_balance'], start + 1000)
+        self.assertEqual(response.json()['closing_balance'], start + 3000)
+
+    def test_late_settlement_balances(self):
+        # A transaction settled after a later one of the wallet (it waited for its exchange rate) goes in between.
+        # Backends that do not return the ids of a bulk INSERT get the history rows saved one by one.
+        for pk, returns_ids in ((3, True), (5, False)):
+            with self.subTest(returns_ids=returns_ids), \
+                    mock.patch.object(connection.features, 'can_return_ids_from_bulk_insert', returns_ids):
+                wallet = Wallet.objects.get(pk=pk)
+                now = timezone.now()
+                early, late = (self._create(wallet_to=wallet, currency=wallet.currency, amount=amount,
+                                            operation='REFILL') for amount in (10, 20))
+                Transaction.objects.filter(pk=early.pk).update(created=now - datetime.timedelta(days=1))
+                Transaction.objects.filter(pk=late.pk).update(created=now)
+                Transaction.objects.filter(pk=early.pk).update(status='claimed', claimed=now)
+                processing_transactions()
+                Transaction.objects.filter(pk=early.pk).update(status='pending', claimed=None)
+                processing_transactions()
+
+                start, wallet = wallet.balance, Wallet.objects.get(pk=pk)
+                history = list(WalletHistory.objects.filter(wallet=wallet).order_by('oper_date', 'pk'))
+                self.assertEqual([row.balance_after - start for row in history], [1000, 3000])
+                self.assertEqual(WalletHistory.objects.balance_at(wallet.pk, now - datetime.timedelta(hours=1)),
+                                 start + 1000)
+                snapshots = WalletBalanceSnapshot.objects.filter(wallet=wallet).order_by('date')
+                self.assertEqual([snapshot.balance - start for snapshot in snapshots], [1000, 3000])
+
+    def test_missing_wallet_rate(self):
+        # The rate of the transaction currency is known, the rate of the receiving wallet currency is not yet
+        wallet_from, wallet_to = Wallet.objects.get(pk=2), Wallet.objects.get(pk=3)
+        transfer = self._create(wallet_from=wallet_from, wallet_to=wallet_to, currency=wallet_from.currency,
+                                amount=10, operation='TRANSFER')
+        get_rate = rate_cache.get_rate
+        with mock.patch.object(rate_cache, 'get_rate', side_effect=lambda currency_id, date: (
+                None if currency_id == wallet_to.currency_id else get_rate(currency_id, date))):
+            processing_transactions()
+        self.assertEqual(Transaction.objects.get(pk=transfer.pk).status, 'pending')
+        self.assertEqual(Wallet.objects.get(pk=2).balance, wallet_from.balance)
+
+    def test_period_totals(self):
+        wallet, partner = Wallet.objects.get(pk=3), Wallet.objects.get(pk=4)
+        day = timezone.localtime().replace(hour=12, minute=0, second=0, microsecond=0) - datetime.timedelta(days=3)
+        for days, hours in ((0, 0), (0, 6), (1, 0), (2, -6), (2, 0), (3, 0)):
+            for tran in (self._create(wallet_to=wallet, currency=wallet.currency, amount=10, operation='REFILL'),
+                         self._create(wallet_from=wallet, wallet_to=partner, currency=partner.currency, amount=1,
+                                      operation='TRANSFER')):
+                Transaction.objects.filter(pk=tran.pk).update(
+                    created=day + datetime.timedelta(days=days, hours=hours))
+        processing_transactions()
+
+        def expected(start_date=None, end_date=None):
+            history = WalletHistory.objects.filter(wallet=wallet)
+            if start_date:
+                history = history.filter(oper_date__gte=start_date)
+            if end_date:
+                history = history.filter(oper_date__lte=end_date)
+            return sorted((row.type, row.oper.currency_id, row.amount, row.oper.usd_amount) for row in history)
+        self.assertEqual(len(expected()), 12)
+
+        periods = [(None, None), (day, None), (None, day), (day + datetime.timedelta(hours=1), day +
+                   datetime.timedelta(days=2)), (day - datetime.timedelta(hours=12), day + datetime.timedelta(hours=6)),
+                   (day + datetime.timedelta(hours=1), day + datetime.timedelta(hours=7))]
+        for start_date, end_date in periods:
+            rows = expected(start_date, end_date)
+            totals = period_totals(wallet.pk, start_date, end_date)
+            self.assertEqual(sum(total['count'] for total in totals), len(rows), (start_date, end_date))
+            for type_, currency_id in {(row[0], row[1]) for row in rows}:
+                total, = [total for total in totals if total['type'] == type_ and total['currency_id'] == currency_id]
+                group = [row for row in rows if row[:2] == (type_, currency_id)]
+                self.assertEqual(total['amount'], sum(row[2] for row in group))
+                self.assertEqual(total['usd_amount'], sum(row[3] for row in group))
+
+        response = self.client.get('/api/client_report', {'name': wallet.name, 'summary': 1})
+        summary = response.json()
+        self.assertEqual(summary['total_in'], sum(row[2] for row in expected() if row[0] == 'IN'))
+        self.assertEqual(summary['total_out'], sum(row[2] for row in expected() if row[0] == 'OUT'))
+        self.assertEqual(summary['closing_balance'], Wallet.objects.get(pk=wallet.pk).balance)
+
+    def test_sharded_settlement(self):
+        wallets = list(Wallet.objects.filter(pk__in=[4, 5]))
+        for wallet in wallets:
+            self._create(wallet_to=wallet, currency=wallet.currency, amount=10, operation='REFILL')
+
+        settle_shard(get_shard(None, 4, shards=2), shards=2)
+        self.assertEqual(Transaction.objects.filter(wallet_to_id=4, status='done').count(), 1)
+        self.assertEqual(Transaction.objects.filter(wallet_to_id=5, status='done').count(), 0)
+
+        with self.settings(SETTLEMENT_SHARDS=2):
+            processing_transactions()
+        self.assertEqual(Transaction.objects.filter(wallet_to_id=5, status='done').count(), 1)
+
+    def test_settlement_on_create(self):
+        wallet = Wallet.objects.get(pk=4)
+        response = self.client.post('/api/wallet_refill_by_name/{}'.format(wallet.name), data={'amount': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Celery is eager in tests, so the refill is settled right away
+        self.assertEqual(Wallet.objects.get(pk=4).balance, wallet.balance + 100)
+
+    def test_settlement_coalescing(self):
+        data = dict(wallet_to_id=4, currency_id=1, amount=1, operation='REFILL')
+        with self.settings(SETTLEMENT_COALESCE_SIZE=3), mock.patch('api.tasks.settle_shard.apply_async') as apply:
+            for _ in range(4):
+                create_transaction(data)
+        # One delayed run for the window, an immediate one when the window is full, then a new window
+        self.assertEqual([('countdown' in kwargs) for _, kwargs in apply.call_args_list], [True, False, True])
+
+        # A per-process cache never sees the run in the worker delete the key, it expires when the run is due
+        cache.clear()
+        with self.settings(SETTLEMENT_COALESCE_WINDOW=0.01), \
+                mock.patch('api.tasks.settle_shard.apply_async') as apply:
+            create_transaction(data)
+            time.sleep(0.02)
+            create_transaction(data)
+        self.assertEqual(apply.call_count, 2)
+
+    def test_stale_claims(self):
+        wallet = Wallet.objects.get(pk=4)
+        claimed = timezone.now() - datetime.timedelta(seconds=settings.SETTLEMENT_CLAIM_TIMEOUT + 1)
+        tran = self._create(wallet_to=wallet, currency=wallet.currency, amount=1, operation='REFILL',
+                            status='claimed', claimed=claimed)
+        fresh = self._create(wallet_to=wallet, currency=wallet.currency, amount=1, operation='REFILL',
+                             status='claimed', claimed=timezone.now())
+
+        processing_transactions()
+        self.assertEqual(Transaction.objects.get(pk=tran.pk).status, 'done')
+        self.assertEqual(Transaction.objects.get(pk=fresh.pk).status, 'claimed')
+
+        # Stale claims are found by the partial index of the claimed rows, not by a scan of all the transactions
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE indexname = 'api_transaction_claimed'")
+            self.assertIn("(claimed) WHERE ((status)::text = 'claimed'::text)", cursor.fetchone()[0])
+
+    def test_balance_conflict(self):
+        wallet_from, wallet_to = Wallet.objects.get(pk=2), Wallet.objects.get(pk=4)
+        transfer = self._create(wallet_from=wallet_from, wallet_to=wallet_to, currency=wallet_from.currency,
+                                amount=1, operation='TRANSFER')
+        overdraft = self._create(wallet_from=wallet_from, wallet_to=wallet_to, currency=wallet_from.currency,
+                                 amount=wallet_from.balance, operation='TRANSFER')
+
+        # Another settler changed a wallet of the batch, it is settled row by row
+        with mock.patch('api.models.WalletQuerySet.inc_balances', return_value=False), \
+                mock.patch.object(metrics, 'inc', wraps=metrics.inc) as inc:
+            processing_transactions()
+        # The overdraft is counted once, by the row by row settlement
+        self.assertEqual([call for call in inc.call_args_list if 'overdraft' in call[1].values()],
+                         [mock.call('payment_settlement_failures_total', reason='overdraft')])
+        self.assertEqual([call for call in inc.call_args_list if 'failed' in call[1].values()],
+                         [mock.call('payment_settlement_transactions_total', result='failed')])
+        self.assertEqual(Transaction.objects.get(pk=transfer.pk).status, 'done')
+        self.assertEqual(Transaction.objects.get(pk=overdraft.pk).status, 'failed')
+        self.assertEqual(Wallet.objects.get(pk=2).balance, wallet_from.balance - 100)
+        self.assertEqual(WalletHistory.objects.filter(oper__created=transfer.created).count(), 2)
+
+    def test_deadlock_retry(self):
+        wallet = Wallet.objects.get(pk=4)
+        tran = self._create(wallet_to=wallet, currency=wallet.currency, amount=1, operation='REFILL')
+        deadlock, deadlock.__cause__ = OperationalError('deadlock detected'), Exception('deadlock detected')
+        deadlock.__cause__.pgcode = '40P01'
+        calls = []
+
+        def settle(batch):
+            calls.append(batch)
+            if len(calls) == 1:
+                raise deadlock
+            return settle_batch(batch)
+
+        # The batch locks its wallets in pk order and runs again when PostgreSQL breaks a deadlock with it
+        with mock.patch('api.tasks.settle_batch', side_effect=settle), \
+                CaptureQueriesContext(connection) as queries:
+            processing_transactions()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Transaction.objects.get(pk=tran.pk).status, 'done')
+        self.assertTrue(any('FROM "api_wallet"' in query['sql'] and 'FOR UPDATE' in query['sql'] and
+                            'ORDER BY "api_wallet"."id" ASC' in query['sql'] for query in queries.captured_queries))
+
+    def test_conditional_balance_update(self):
+        wallet = Wallet.objects.get(pk=2)
+        self.assertFalse(Wallet.objects.inc_balance(wallet.pk, -wallet.balance - 1))
+        self.assertTrue(Wallet.objects.inc_balance(wallet.pk, -wallet.balance))
+        self.assertFalse(Wallet.objects.inc_balances({wallet.pk: 10}, {wallet.pk: wallet.version}))
+        self.assertTrue(Wallet.objects.inc_balances({wallet.pk: 10}, {wallet.pk: wallet.version + 1}))
+        self.assertEqual(Wallet.objects.get(pk=2).balance, 10)
+
+
+class TestConcurrentSettlement(TransactionTestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        rate_cache.invalidate()
+        cache.clear()
+
+    def test_shards_credit_one_wallet(self):
+        # Wallet 4 (shard 0) is credited by refills of its shard and by transfers from wallet 3 of shard 1
+        Wallet.objects.filter(pk=3).update(balance=100000)
+        wallet, partner = Wallet.objects.get(pk=4), Wallet.objects.get(pk=3)
+        created = []
+        for _ in range(20):
+            created.append(Transaction.objects.create(wallet_to=wallet, currency=wallet.currency, amount=1,
+                                                      operation='REFILL').pk)
+            created.append(Transaction.objects.create(wallet_from=partner, wallet_to=wallet, currency=wallet.currency,
+                                                      amount=1, operation='TRANSFER').pk)
+
+        def settle(shard):
+            try:
+                return settle_shard(shard, shards=2, batch_size=5)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=2) as executor, \
+                mock.patch('api.tasks.settle_transaction', wraps=settle_transaction) as row_by_row:
+            for run in [executor.submit(settle, shard) for shard in range(2)]:
+                run.result()
+
+        # Only the cross-shard transfers are settled row by row, the batches of the shards never conflict
+        self.assertEqual(row_by_row.call_count, 20)
+        self.assertEqual(Transaction.objects.filter(pk__in=created, status='done').count(), 40)
+        balance = Wallet.objects.get(pk=4).balance
+        self.assertEqual(balance, wallet.balance + 40 * 100)
+        history = list(WalletHistory.objects.filter(wallet=wallet).order_by('oper_date', 'pk')
+                       .values_list('amount', 'balance_after'))
+        self.assertEqual([balance_after for _, balance_after in history[-40:]],
+                         [wallet.balance + 100 * number for number in range(1, 41)])
+
+
+class TestExchangeRateCache(APITestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        rate_cache.invalidate()
+
+    def test_rate_lookup(self):
+        rates = ExchangeRate.objects.filter(currency_id=1).order_by('created')
+        first, last = rates.first(), rates.last()
+        misses = rate_cache.misses
+
+        self.assertEqual(rate_cache.get_rate(1, last.created), last.rate)
+        self.assertEqual(rate_cache.get_rate(1, first.created), first.rate)
+        self.assertIsNone(rate_cache.get_rate(1, first.created - datetime.timedelta(seconds=1)))
+        self.assertEqual(rate_cache.misses, misses + 1)
+
+        # A rate created through the api invalidates the currency timeline
+        created = last.created + datetime.timedelta(days=1)
+        response = self.client.post('/api/exchange_rate', data={
+            'currency': 'USD', 'rate': 1.5, 'created': created.strftime('%Y-%m-%d %H:%M:%S')})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(rate_cache.get_rate(1, created), 1.5)
+        self.assertEqual(rate_cache.misses, misses + 2)
+
+    def test_invalidation_sync(self):
+        # Another process: its timeline is dropped on the next sync after an invalidation here
+        other = ExchangeRateCache(size=10, ttl=60, max_points=100)
+        other.sync()
+        last = ExchangeRate.objects.filter(currency_id=1).latest('created')
+        self.assertEqual(other.get_rate(1, last.created), last.rate)
+        ExchangeRate.objects.filter(pk=last.pk).update(rate=last.rate * 2)
+        rate_cache.invalidate(1)
+        self.assertEqual(other.get_rate(1, last.created), last.rate)
+        other.sync()
+        self.assertEqual(other.get_rate(1, last.created), last.rate * 2)
+
+
+class TestRatesLoading(APITestCase):
+    fixtures = ['test.json']
+
+    def test_bulk_endpoint(self):
+        url = '/api/exchange_rate/bulk'
+        rates = [{'currency': 'EUR', 'rate': 0.9, 'created': '2030-01-0{} 10:00:00'.format(day)} for day in (1, 2, 3)]
+        response = self.client.post(url, data=rates, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(ExchangeRate.objects.filter(currency_id=2, created__year=2030).count(), 3)
+
+        # An existing (currency, created) gets the new rate
+        body = 'currency,rate,created\r\n2,0.8,2030-01-01 10:00:00\r\nCAD,1.3,2030-01-01\r\n'
+        response = self.client.generic('POST', url, body, content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(ExchangeRate.objects.filter(currency_id=2, created__year=2030).count(), 3)
+        self.assertEqual(ExchangeRate.objects.filter(currency_id=2, created__year=2030).order_by('created')
+                         .first().rate, 0.8)
+        self.assertEqual(rate_cache.get_rate(3, timezone.now().replace(year=2031)), 1.3)
+
+        # Nothing is loaded when a row is invalid
+        response = self.client.post(url, format='json', data=[
+            {'currency': 'EUR', 'rate': 1, 'created': '2031-01-01'},
+            {'currency': 'XXX', 'rate': -1, 'created': 'yesterday'}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(response.data['errors'][2]), 3)
+        self.assertFalse(ExchangeRate.objects.filter(created__year=2031).exists())
+
+    def test_load_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as rates_file:
+            rates_file.write('currency,rate,created\n')
+            for day in range(1, 366):
+                created = datetime.datetime(2029, 1, 1) + datetime.timedelta(days=day)
+                rates_file.write('USD,1,{0}\nCNY,6.5,{0}\n'.format(created.strftime('%Y-%m-%d')))
+            rates_file.flush()
+            out = io.StringIO()
+            call_command('load_exchange_rates', rates_file.name, stdout=out)
+        self.assertIn('730 exchange rates loaded', out.getvalue())
+        self.assertEqual(ExchangeRate.objects.filter(created__year__gte=2029).count(), 730)
+
+        # created is filled in without saving the rate twice
+        with self.assertNumQueries(1):
+            rate = ExchangeRate(currency_id=1, rate=1)
+            rate.save()
+        self.assertIsNotNone(rate.created)
+
+
+class TestCurrencyRegistry(APITestCase):
+    fixtures = ['test.json']
+
+    def test_lookup(self):
+        currency_registry.refresh()
+        self.assertEqual(currency_registry.get_by_iso('EUR').pk, 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(currency_registry.get(1).currency, 'USD')
+            self.assertIsNone(currency_registry.get_by_iso('XXX'))
+            self.assertEqual(set(currency_registry.by_pk()), {1, 2, 3, 4})
+
+        # Saving a currency refreshes the registry
+        Currency.objects.create(currency_name='Russian ruble', currency='RUB', fractional=100)
+        self.assertEqual(currency_registry.get_by_iso('RUB').currency_name, 'Russian ruble')
+
+        # Wallets are created and listed without currency queries
+        response = self.client.post('/api/client', data={'name': 'Rouble', 'city': 'Moscow', 'country': 'Russia',
+                                                         'currency': 'RUB'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['currency'], 'RUB')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/client', {'cursor': '', 'count': 'none'})
+        self.assertEqual(response.data['results'][0]['currency'], Wallet.objects.first().currency.currency)
+
+
+class TestMetrics(APITestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        # Drop the values left by other tests
+        metrics.flush()
+        Metric.objects.all().delete()
+
+    def scrape(self):
+        started = []
+        app = metrics_app(lambda environ, start_response: [], '/metrics/')
+        body = b''.join(app({'PATH_INFO': '/metrics/'}, lambda status, headers: started.append(status)))
+        self.assertEqual(started, ['200 OK'])
+        return body.decode('utf-8').splitlines()
+
+    def test_metrics(self):
+        wallet_from, wallet_to = Wallet.objects.get(pk=2), Wallet.objects.get(pk=3)
+        response = self.client.post('/api/wallet_refill_by_name/{}'.format(wallet_to.name), data={'amount': 10})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        Transaction.objects.create(wallet_from=wallet_from, wallet_to=wallet_to, currency=wallet_from.currency,
+                                   amount=wallet_from.balance * 10, operation='TRANSFER')
+        processing_transactions()
+
+        lines = self.scrape()
+        self.assertIn('# TYPE payment_api_request_duration_seconds histogram', lines)
+        self.assertIn('payment_api_request_duration_seconds_count{method="POST",view="wallet_refill_by_name"} 1.0',
+                      lines)
+        self.assertIn('payment_api_responses_total{status="200",view="wallet_refill_by_name"} 1.0', lines)
+        self.assertIn('payment_settlement_failures_total{reason="overdraft"} 1.0', lines)
+        self.assertIn('payment_transactions_pending 0.0', lines)
+        self.assertTrue(any(line.startswith('payment_settlement_stage_seconds_bucket{le="+Inf",stage="balance_update"}')
+                            for line in lines))
+
+        # Values of every process are added up in the shared table
+        metrics.inc('payment_api_responses_total', view='wallet_refill_by_name', status=200)
+        metrics.flush()
+        self.assertEqual(Metric.objects.get(name='payment_api_responses_total',
+                                            labels='status="200",view="wallet_refill_by_name"').value, 2)
+
+    def test_flush_errors(self):
+        # A failed flush answers the request as usual and keeps the values for the next flush
+        with mock.patch('api.metrics.upsert', side_effect=DatabaseError('deadlock detected')), \
+                mock.patch.object(metrics, 'flush_interval', 0):
+            response = self.client.post('/api/wallet_refill_by_name/Aarav', data={'amount': 10})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertFalse(metrics.flush())
+        self.assertFalse(Metric.objects.exists())
+        self.assertTrue(metrics.flush())
+        self.assertEqual(Metric.objects.get(name='payment_api_responses_total',
+                                            labels='status="200",view="wallet_refill_by_name"').value, 1)
+
+
+class TestMiddleware(APITestCase):
+    fixtures = ['test.json']
+
+    def test_json_errors(self):
+        url = '/api/wallet_refill_by_name/Aarav'
+        with mock.patch('api.views.ingest_transaction', side_effect=Exception('Broker is down')):
+            response = self.client.post(url, data={'amount': 10})
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(response.json(), {'non_field_errors': ['Broker is down']})
+
+        with mock.patch('api.views.ingest_transaction', side_effect=ValidationError('Wrong amount')):
+            response = self.client.post(url, data={'amount': 10})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), 'Wrong amount')
+
+    @override_settings(SQL_PROFILING=True, SQL_PROFILING_HEADERS=True, SQL_PROFILING_REPEATED_QUERIES=3)
+    def test_sql_profiling(self):
+        response = self.client.get('/api/client_report', {'name': 'Aarav', 'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(int(response['X-DB-Queries']), 0)
+        self.assertEqual(response['X-DB-Repeated'], '0')
+        self.assertIn('X-DB-Time', response)
+
+        # The same query with different parameters is an N+1
+        def ingest(data):
+            for pk in Wallet.objects.values_list('pk', flat=True)[:3]:
+                Wallet.objects.filter(pk=pk).first()
+
+        with mock.patch('api.views.ingest_transaction', side_effect=ingest), self.assertLogs(level='WARNING') as logs:
+            response = self.client.post('/api/wallet_refill_by_name/Aarav', data={'amount': 10})
+        self.assertEqual(response['X-DB-Repeated'], '3')
+        self.assertTrue(any('query repeated 3 times' in line for line in logs.output))
+
+
+class TestAsgiIngestion(TransactionTestCase):
+    fixtures = ['test.json']
+
+    def setUp(self):
+        from payment_system import asgi
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        patcher = mock.patch.object(asgi, 'executor', self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        # The database connection of the executor thread is persistent
+        self.executor.submit(lambda: connection.close()).result()
+        self.executor.shutdown()
+
+    def call(self, method, path, body=b'', content_type='application/x-www-form-urlencoded'):
+        from payment_system.asgi import application
+        scope = dict(type='http', method=method, path=path, headers=[(b'content-type', content_type.encode())])
+        messages = [dict(type='http.request', body=body[:5], more_body=True),
+                    dict(type='http.request', body=body[5:], more_body=False)]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.get_event_loop().run_until_complete(application(scope, receive, send))
+        return sent[0]['status'], json.loads(sent[1]['body'].decode('utf-8'))
+
+    def test_ingestion(self):
+        cache.clear()
+        aarav = Wallet.objects.get(name='Aarav')
+        status_code, data = self.call('POST', '/api/wallet_refill_by_name/Aarav', b'amount=10')
+        self.assertEqual((status_code, data), (200, {'result': 'success', 'message': 'Transaction REFILL created'}))
+        self.assertGreater(Wallet.objects.get(name='Aarav').balance, aarav.balance)
+
+        transfers = Transaction.objects.filter(operation='TRANSFER').count()
+        status_code, data = self.call('POST', '/api/wallet2wallet_by_name/Aarav/Aaden', b'amount=1&currency_use=TO')
+        self.assertEqual((status_code, data), (200, {'result': 'success', 'message': 'Transaction TRANSFER created'}))
+        self.assertEqual(Transaction.objects.filter(operation='TRANSFER').count(), transfers + 1)
+
+        # Validation errors are the same as of the WSGI views
+        response = self.client.post('/api/wallet2wallet_by_name/Aarav/Aaden', data={'amount': 1})
+        self.assertEqual(self.call('POST', '/api/wallet2wallet_by_name/Aarav/Aaden', b'amount=1'),
+                         (response.status_code, response.json()))
+        response = self.client.post('/api/wallet_refill_by_name/Nobody', data={'amount': 'ten'})
+        self.assertEqual(self.call('POST', '/api/wallet_refill_by_name/Nobody', b'amount=ten'),
+                         (response.status_code, response.json()))
+
+        self.assertEqual(self.call('GET', '/api/wallet_refill_by_name/Aarav')[0], 405)
+        self.assertEqual(self.call('POST', '/api/client')[0], 404)
+
+
+class TestReplicaRouting(APITestCase):
+    fixtures = ['test.json']
+
+    @override_settings(REPLICA_DATABASES=['replica_0', 'replica_1'], REPLICA_MAX_LAG=5)
+    def test_router(self):
+        router = ReplicaRouter()
+        lags = {'replica_0': 1, 'replica_1': None}
+        with mock.patch('payment_system.routers.replica_lag', side_effect=lags.get):
+            self.assertIsNone(router.db_for_read(Wallet))
+            with read_only():
+                self.assertEqual(router.db_for_read(Wallet), 'replica_0')
+                # A lagging or unavailable replica is skipped
+                lags['replica_0'] = 10
+                self.assertIsNone(router.db_for_read(Wallet))
+                lags['replica_1'] = 0
+                self.assertEqual(router.db_for_read(Wallet), 'replica_1')
+                # After a write the block reads from the primary
+                self.assertEqual(router.db_for_write(Wallet), 'default')
+                self.assertIsNone(router.db_for_read(Wallet))
+        self.assertFalse(router.allow_migrate('replica_0', 'api'))
+        self.assertIsNone(router.allow_migrate('default', 'api'))
+
+    def test_replica_lag(self):
+        # The primary is not in recovery, so it has no lag
+        self.assertEqual(replica_lag('default'), 0)
+
+    def test_middleware(self):
+        with mock.patch('api.middleware.read_only', wraps=read_only) as replica:
+            response = self.client.get('/api/client')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(replica.call_count, 1)
+            response = self.client.get('/api/client_report', {'name': 'Aarav', 'export_file_type': 'csv'})
+            b''.join(response.streaming_content)
+            self.assertEqual(replica.call_count, 3)
+
+            # A client that wrote reads from the primary
+            response = self.client.post('/api/client', data={'name': 'Pinned', 'city': 'Moscow', 'country': 'Russia',
+                                                             'currency': 'USD'})
+            self.assertEqual(response.cookies[settings.REPLICA_PIN_COOKIE]['max-age'], settings.REPLICA_PIN_SECONDS)
+            self.client.get('/api/client/{}'.format(response.data['id']))
+            self.assertEqual(replica.call_count, 3)
+
+
+class TestConnectionPool(TestCase):
+
+    def test_pool(self):
+        settings_dict = dict(connection.settings_dict, OPTIONS={'pool': {'max_size': 1, 'timeout': 0.1,
+                                                                         'check_after': 0}})
+        first, second = DatabaseWrapper(settings_dict, alias='pooled'), DatabaseWrapper(settings_dict, alias='pooled')
+        self.addCleanup(first.pool.close)
+
+        first.ensure_connection()
+        raw = first.connection
+        # The only connection of the pool is taken
+        with self.assertRaises(PoolTimeout):
+            second.ensure_connection()
+
+        # A closed wrapper gives the connection back, an open transaction is rolled back
+        first.set_autocommit(False)
+        first.cursor().execute('SELECT 1')
+        first.close()
+        self.assertEqual(first.pool.size, 1)
+        second.ensure_connection()
+        self.assertIs(second.connection, raw)
+        with second.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        second.close()
+
+        # A broken connection is replaced on the health check
+        raw.close()
+        first.ensure_connection()
+        self.assertIsNot(first.connection, raw)
+        self.assertEqual(first.pool.size, 1)
+        first.close()
+
+
+class TestPartitions(TestCase):
+    fixtures = ['test.json']
+    month = datetime.date(2019, 5, 1)
+
+    def _count(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM {}'.format(table))
+            return cursor.fetchone()[0]
+
+    def test_create(self):
+        current = month_start(timezone.now().date())
+        for table in PARTITIONED:
+            self.assertIn(current, partitions(table))
+            self.assertEqual(len(partitions(table)), settings.PARTITION_MONTHS_AHEAD + 1)
+        self.assertEqual(ensure_partitions(settings.PARTITION_MONTHS_AHEAD), [])
+
+        # Fixture rows are older than the partitions, they are moved from the default partition to their own
+        self.assertEqual(self._count('api_wallethistory_default'), 8)
+        call_command('partitions', 'create', stdout=io.StringIO())
+        self.assertTrue(create_partition('api_wallethistory', self.month))
+        self.assertFalse(create_partition('api_wallethistory', self.month))
+        self.assertEqual(self._count('api_wallethistory_default'), 0)
+        self.assertEqual(self._count('api_wallethistory_p2019_05'), 8)
+        self.assertEqual(WalletHistory.objects.count(), 8)
+
+    def test_archive(self):
+        for table in PARTITIONED:
+            create_partition(table, self.month)
+        pending = Transaction.objects.create(wallet_to_id=2, currency_id=1, amount=1, operation='REFILL')
+        Transaction.objects.filter(pk=pending.pk).update(created=timezone.now().replace(year=2019, month=5, day=6))
+        WalletBalanceSnapshot.objects.create(wallet_id=2, date=datetime.date(2019, 5, 5), balance=123)
+
+        # Transactions waiting for settlement stay in place
+        output = io.StringIO()
+        call_command('partitions', 'archive', before=timezone.localtime().strftime('%Y-%m'), stdout=output)
+        self.assertIn('Archived api_wallethistory_p2019_05', output.getvalue())
+        self.assertNotIn('api_transaction_p2019_05', output.getvalue())
+        self.assertEqual(WalletHistory.objects.count(), 0)
+        self.assertEqual(self._count('archive.api_wallethistory'), 8)
+        self.assertEqual(self._count('archive.api_operation'), 6)
+        # Opening balances of the archived operations come from the end of day balances
+        self.assertEqual(WalletHistory.objects.balance_at(2), 123)
+
+        Transaction.objects.filter(pk=pending.pk).update(status='done')
+        self.assertEqual(archive_partitions(timezone.localtime().date()), ['api_transaction_p2019_05'])
+        self.assertEqual(self._count('archive.api_transaction'), 7)
+
+    def test_pruning(self):
+        create_partition('api_wallethistory', self.month)
+        create_partition('api_operation', self.month)
+        start = timezone.now() - datetime.timedelta(minutes=1)
+        queryset = WalletHistory.objects.filter(wallet_id=2, oper_date__range=(start, timezone.now())) \
+            .with_operation().select_related('oper')
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row for row, in cursor.fetchall())
+        self.assertIn(partition_name('api_wallethistory', month_start(start.date())), plan)
+        self.assertNotIn('api_wallethistory_p2019_05', plan)
+        self.assertNotIn('api_wallethistory_default', plan)
+
+
+class TestLoadTest(TestCase):
+    fixtures = ['test.json']
+
+    def test_loadtest(self):
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 99), 4)
+
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('loadtest', requests=5, concurrency=1, wallets=3, output=output.name, stdout=io.StringIO())
+            report = json.load(output)
+        self.assertEqual(report['requests'], 20)
+        self.assertEqual(report['endpoints']['wallet_refill_by_name']['accepted'], 5)
+        self.assertEqual(report['endpoints']['client']['errors'], 0)
+        self.assertEqual(report['settlement_lag_ms']['unsettled'], 0)
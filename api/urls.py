@@ -1,6 +1,7 @@
 from django.conf.urls import url
 from rest_framework.routers import SimpleRouter
-from .views import ClientView, ExchangeRateView, WalletRefillByNameView, WalletToWalletByNameView, ClientReportView
+from .views import ClientView, ExchangeRateView, WalletRefillByNameView, WalletToWalletByNameView, ClientReportView, \
+    TransactionBatchView
 
 router = SimpleRouter(trailing_slash=False)
 router.register('client', ClientView, base_name='client')
@@ -11,5 +12,6 @@ urlpatterns = router.urls + [
     url(r'^wallet_refill_by_name/(?P<name>[A-z0-9-_]+)$', WalletRefillByNameView.as_view(),
         name='wallet_refill_by_name'),
     url(r'^wallet2wallet_by_name/(?P<from_name>[A-z0-9-_]+)/(?P<to_name>[A-z0-9-_]+)$',
-        WalletToWalletByNameView.as_view(), name='wallet2wallet_by_name')
+        WalletToWalletByNameView.as_view(), name='wallet2wallet_by_name'),
+    url(r'^transactions/batch$', TransactionBatchView.as_view(), name='transactions_batch')
 ]
@@ -1,21 +1,25 @@
-import csv
-from django.utils.encoding import smart_str
-from django.core.serializers.xml_serializer import Serializer as XMLSerializer
-from django.http import HttpResponse
-from django.utils.decorators import method_decorator
+import itertools
+from collections import OrderedDict
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
 from django.db.models import Q
-from rest_framework.status import HTTP_200_OK
+from rest_framework.status import HTTP_200_OK, HTTP_400_BAD_REQUEST
 from rest_framework.viewsets import GenericViewSet
 from rest_framework import mixins
 from rest_framework.response import Response
-from rest_framework.decorators import APIView
+from rest_framework.decorators import APIView, action
 from rest_framework import serializers
-from .tasks import create_transaction
-from .decorators import handle_error_json
+from .cache import rate_cache, wallet_names, currency_registry
 from .models import Wallet, WalletHistory, ExchangeRate
-from .serializers import ExchangeRateSerializer, WalletSerializer, ClientReportSerializer, \
-    WalletRefillByNameSerializer, WalletToWalletByNameSerializer, WalletHistorySerializer
-from payment_system.pagination import ResultsSetPagination
+from .ingestion import ingest_transaction, submit_batch, refill_by_name, transfer_by_name
+from .rates import read_rates, load_rates, RatesError
+from .reports import iter_chunks, csv_stream, history_page, encode_report_cursor, period_totals, \
+    StreamingXMLSerializer, CSV_FIELDS
+from .serializers import ExchangeRateSerializer, WalletSerializer, ClientReportSerializer, WalletHistorySerializer
+from payment_system.pagination import CursorResultsSetPagination
 
 
 class ClientView(mixins.RetrieveModelMixin, mixins.ListModelMixin, mixins.CreateModelMixin, GenericViewSet):
@@ -31,13 +35,45 @@ class ClientView(mixins.RetrieveModelMixin, mixins.ListModelMixin, mixins.Create
     """
     serializer_class = WalletSerializer
     queryset = Wallet.objects.all()
-    pagination_class = ResultsSetPagination
+    pagination_class = CursorResultsSetPagination
+    replica_reads = True
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        wallet_names.invalidate(serializer.instance.name)
 
 
 class ExchangeRateView(mixins.RetrieveModelMixin, mixins.ListModelMixin, mixins.CreateModelMixin, GenericViewSet):
     serializer_class = ExchangeRateSerializer
     queryset = ExchangeRate.objects.all()
-    pagination_class = ResultsSetPagination
+    pagination_class = CursorResultsSetPagination
+    replica_reads = True
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        rate_cache.invalidate(serializer.instance.currency_id)
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        """
+        Load many exchange rates at once: a JSON array of {currency, rate, created}, a text/csv body or a "file"
+        upload (.csv or .json). Existing rates of the same currency and date are replaced.
+        """
+        try:
+            if request.content_type.startswith('text/csv'):
+                rows = read_rates(request.body.decode('utf-8-sig'), 'csv')
+            elif 'file' in request.FILES:
+                upload = request.FILES['file']
+                rows = read_rates(upload.read().decode('utf-8-sig'), 'csv' if upload.name.endswith('.csv') else 'json')
+            else:
+                rows = request.data
+            loaded = load_rates(rows)
+        except RatesError as err:
+            return Response(data={'errors': err.errors}, status=HTTP_400_BAD_REQUEST)
+        except ValueError as err:
+            return Response(data={'non_field_errors': ["{}".format(err)]}, status=HTTP_400_BAD_REQUEST)
+        return Response(data=dict(result="success", message="{} exchange rates loaded".format(loaded)),
+                        status=HTTP_200_OK)
 
 
 class WalletRefillByNameView(APIView):
@@ -45,23 +81,9 @@ class WalletRefillByNameView(APIView):
     Top up wallet balance by wallet name
     """
 
-    @method_decorator(handle_error_json())
     def post(self, request, *args, **kwargs):
-        data = kwargs.copy()
-        data['amount'] = request.POST.get('amount')
-
-        serializer = WalletRefillByNameSerializer(data=data)
-        if not serializer.is_valid():
-            raise serializers.ValidationError(serializer.errors)
-
-        wallet = serializer.validated_data['name']
         # Create a purse replenishment transaction.
-        transaction_data = dict(wallet_to_id=wallet.pk,
-                                currency_id=wallet.currency.pk,
-                                amount=request.POST.get('amount'),
-                                operation='REFILL')
-        #TODO: Mb remove Celery + rabbitmq? Need Ddos test.
-        create_transaction.delay(transaction_data)
+        ingest_transaction(refill_by_name(kwargs['name'], request.POST.get('amount')))
         return Response(data=dict(result="success", message="Transaction REFILL created"), status=HTTP_200_OK)
 
 
@@ -70,32 +92,72 @@ class WalletToWalletByNameView(APIView):
     Money transfer from client> client by name.
     """
 
-    @method_decorator(handle_error_json())
     def post(self, request, *args, **kwargs):
-        data = kwargs.copy()
-        data['currency_use'] = request.POST.get('currency_use')
-        data['amount'] = request.POST.get('amount')
-        serializer = WalletToWalletByNameSerializer(data=data)
-        if not serializer.is_valid():
-            raise serializers.ValidationError(serializer.errors)
-
         # Create a transfer transaction from client> client
-        wallet_from = serializer.validated_data['wallet_from']
-        wallet_to = serializer.validated_data['wallet_to']
-        transaction_data = dict(
-            operation='TRANSFER',
-            wallet_from_id=wallet_from.pk,
-            wallet_to_id=wallet_to.pk,
-            currency_id=wallet_from.currency.pk if data['currency_use'] == 'FROM' else wallet_to.currency.pk,
-            amount=data['amount'])
-        #TODO: Mb remove Celery + rabbitmq? Need Ddos test.
-        create_transaction.delay(transaction_data)
+        ingest_transaction(transfer_by_name(kwargs['from_name'], kwargs['to_name'], request.POST.get('currency_use'),
+                                            request.POST.get('amount')))
         return Response(data=dict(result="success", message="Transaction TRANSFER created"), status=HTTP_200_OK)
 
 
+class TransactionBatchView(APIView):
+    """
+    Many refills and transfers in one request: a JSON array of {"operation": "REFILL", "name", "amount"} and
+    {"operation": "TRANSFER", "from_name", "to_name", "currency_use", "amount"} items. Every item is accepted or
+    rejected on its own.
+    """
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        if not isinstance(items, list):
+            raise serializers.ValidationError({'non_field_errors': ["A JSON array of transactions is expected."]})
+        if len(items) > settings.TRANSACTION_BATCH_MAX_SIZE:
+            raise serializers.ValidationError({'non_field_errors': [
+                "No more than {} transactions in a batch.".format(settings.TRANSACTION_BATCH_MAX_SIZE)]})
+
+        results = submit_batch(items)
+        accepted = sum(result['result'] == 'accepted' for result in results)
+        return Response(data=OrderedDict([
+            ('result', "success"),
+            ('accepted', accepted),
+            ('rejected', len(results) - accepted),
+            ('items', results)
+        ]), status=HTTP_200_OK)
+
+
 class ClientReportView(APIView):
+    """
+    Wallet operation history. The JSON report is paged by (oper_date, id): passing any of cursor, page_size, since_id
+    or since returns a page {next, page_size, results}, next is the cursor of the following page. Without them the
+    report is the plain list of all the rows, as before paging.
+    Opening (before start_date) and closing (at end_date) balances are in the page or in the X-Opening-Balance and
+    X-Closing-Balance headers. summary=1 returns the period totals by operation type and currency instead.
+    """
+    paging_params = ('cursor', 'page_size', 'since_id', 'since')
+    replica_reads = True
+
+    def get_balances(self, wallet, start_date=None, end_date=None):
+        """
+        Balances before start_date and at end_date, from the running balances of the history
+        """
+        opening_balance = WalletHistory.objects.balance_at(wallet.pk, start_date, inclusive=False) \
+            if start_date else 0
+        return opening_balance, WalletHistory.objects.balance_at(wallet.pk, end_date)
+
+    def get_summary(self, wallet, start_date=None, end_date=None):
+        totals = period_totals(wallet.pk, start_date, end_date)
+        for total in totals:
+            total['currency'] = str(currency_registry.get(total.pop('currency_id')))
+        opening_balance, closing_balance = self.get_balances(wallet, start_date, end_date)
+        return OrderedDict([
+            ('name', wallet.name),
+            ('opening_balance', opening_balance),
+            ('closing_balance', closing_balance),
+            ('total_in', sum(total['amount'] for total in totals if total['type'] == 'IN')),
+            ('total_out', sum(total['amount'] for total in totals if total['type'] == 'OUT')),
+            ('usd_amount', sum(total['usd_amount'] for total in totals)),
+            ('totals', totals)
+        ])
 
-    @method_decorator(handle_error_json())
     def get(self, request):
         data = request.GET.copy()
         serializer = ClientReportSerializer(data=data)
@@ -103,54 +165,69 @@ class ClientReportView(APIView):
             raise serializers.ValidationError(serializer.errors)
 
         wallet = serializer.validated_data['name']
+        if serializer.validated_data.get('summary'):
+            return Response(self.get_summary(wallet, serializer.validated_data.get('start_date'),
+                                             serializer.validated_data.get('end_date')), status=HTTP_200_OK)
+
         args = Q()
-        args &= Q(wallet=wallet)
+        args &= Q(wallet_id=wallet.pk)
         if 'start_date' in serializer.validated_data:
             args &= Q(oper_date__gte=serializer.validated_data['start_date'])
         if 'end_date' in serializer.validated_data:
             args &= Q(oper_date__lte=serializer.validated_data['end_date'])
+        if 'since_id' in serializer.validated_data:
+            args &= Q(pk__gt=serializer.validated_data['since_id'])
+        if 'since' in serializer.validated_data:
+            args &= Q(oper_date__gt=serializer.validated_data['since'])
 
-        wallet_history = WalletHistory.objects.filter(args).prefetch_related('oper', 'oper__currency')
-        if not wallet_history.exists():
-            raise serializers.ValidationError({'non_field_errors': ["There are no transactions for this wallet."]})
+        wallet_history = WalletHistory.objects.filter(args).with_operation()
+        no_transactions = serializers.ValidationError(
+            {'non_field_errors': ["There are no transactions for this wallet."]})
 
-        # Report file generation.
+        # Report file generation. Files are streamed chunk by chunk, gzip compressed if the client accepts it.
         export_file_type = data.get('export_file_type')
-        if export_file_type == 'xml':
-            xml_serializer = XMLSerializer()
-            xml_serializer.serialize(wallet_history)
-            response = HttpResponse(xml_serializer.getvalue(), content_type='text/xml', status=HTTP_200_OK)
-            response['Content-Disposition'] = 'attachment; filename="Report for {}.xml"'.format(wallet.name)
-            return response
-        elif export_file_type == 'csv':
-            response = HttpResponse(content_type='text/csv', status=HTTP_200_OK)
-            response['Content-Disposition'] = 'attachment; filename="Report for {}.csv"'.format(wallet.name)
-            values = [
-                'oper',
-                'type',
-                'wallet_partner',
-                'wallet_partner_name',
-                'oper_date',
-                'amount',
-                'oper__currency__currency',
-                'oper__usd_amount',
-            ]
-            values_trans = [
-                'Operation ID',
-                'Type of',
-                'Customer ID',
-                'Customer Name',
-                'Time',
-                'Amount of operation',
-                'Transaction Currency',
-                'USD amount'
-            ]
-            writer = csv.writer(response, csv.excel)
-            response.write(u'\ufeff'.encode('utf8'))  # BOM (optional...Excel needs it to open UTF-8 file properly)
-            writer.writerow([smart_str(val) for val in values_trans])
-            queryset = wallet_history.values(*values)
-            for obj in queryset.iterator():
-                writer.writerow([smart_str(obj[smart_str(val)]) for val in values])
+        if export_file_type in ('xml', 'csv'):
+            if export_file_type == 'xml':
+                queryset = wallet_history
+                content_type = 'text/xml'
+            else:
+                queryset = wallet_history.values('pk', *CSV_FIELDS)
+                content_type = 'text/csv'
+            chunks = iter_chunks(queryset)
+            first = next(chunks, None)
+            if first is None:
+                raise no_transactions
+            chunks = itertools.chain([first], chunks)
+            content = StreamingXMLSerializer().stream(chunks) if export_file_type == 'xml' else csv_stream(chunks)
+
+            response = StreamingHttpResponse(content, content_type=content_type, status=HTTP_200_OK)
+            response['Content-Disposition'] = 'attachment; filename="Report for {}.{}"'.format(
+                wallet.name, export_file_type)
+            patch_vary_headers(response, ('Accept-Encoding',))
+            if re_accepts_gzip.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+                response.streaming_content = compress_sequence(response.streaming_content)
+                response['Content-Encoding'] = 'gzip'
             return response
 
-        return Response(WalletHistorySerializer(wallet_history, many=True).data, status=HTTP_200_OK)
+        wallet_history = wallet_history.select_related('oper__currency')
+        opening_balance, closing_balance = self.get_balances(wallet, serializer.validated_data.get('start_date'),
+                                                             serializer.validated_data.get('end_date'))
+        if any(param in serializer.validated_data for param in self.paging_params):
+            page_size = serializer.validated_data.get('page_size', settings.REPORT_PAGE_SIZE)
+            page, next_position = history_page(wallet_history, page_size, serializer.validated_data.get('cursor'))
+            # An empty page is a valid answer to "what changed since"
+            return Response(OrderedDict([
+                ('next', encode_report_cursor(*next_position) if next_position else None),
+                ('page_size', page_size),
+                ('opening_balance', opening_balance),
+                ('closing_balance', closing_balance),
+                ('results', WalletHistorySerializer(page, many=True).data)
+            ]), status=HTTP_200_OK)
+
+        results = WalletHistorySerializer(wallet_history.order_by('oper_date', 'pk'), many=True).data
+        if not results:
+            raise no_transactions
+        response = Response(results, status=HTTP_200_OK)
+        response['X-Opening-Balance'] = opening_balance
+        response['X-Closing-Balance'] = closing_balance
+        return response
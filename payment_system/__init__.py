@@ -0,0 +1 @@
+from .celeryconf import app as celery_app
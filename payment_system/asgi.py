@@ -0,0 +1,137 @@
+"""ASGI application for the transaction ingestion endpoints.
+
+Serves POST /api/wallet_refill_by_name/<name> and /api/wallet2wallet_by_name/<from_name>/<to_name> with the
+validation and the responses of the WSGI views, everything else is left to WSGI (404 here). Run it with an ASGI
+server, e.g.
+
+    uvicorn payment_system.asgi:application --host 0.0.0.0 --port 8001
+
+and route the two endpoints to it. The ORM and the Celery publish are blocking, so they run on a pool of
+ASGI_DB_THREADS threads (one database connection each): in-flight requests wait on the event loop, not in a thread.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'payment_system.settings')
+django.setup()
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousOperation
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.urls import resolve, Resolver404
+from rest_framework import serializers
+from api.ingestion import ingest_transaction, refill_by_name, transfer_by_name, transaction_buffer
+from api.metrics import metrics
+
+executor = ThreadPoolExecutor(max_workers=settings.ASGI_DB_THREADS, thread_name_prefix='asgi-db')
+
+SUBMITTERS = {
+    'wallet_refill_by_name': lambda form, name: refill_by_name(name, form.get('amount')),
+    'wallet2wallet_by_name': lambda form, from_name, to_name: transfer_by_name(
+        from_name, to_name, form.get('currency_use'), form.get('amount')),
+}
+
+
+def _form(scope, body):
+    # Form and multipart bodies are parsed by Django, like request.POST of the views
+    headers = dict(scope['headers'])
+    return WSGIRequest({
+        'REQUEST_METHOD': scope['method'],
+        'PATH_INFO': scope['path'],
+        'CONTENT_TYPE': headers.get(b'content-type', b'').decode('latin1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': BytesIO(body),
+    }).POST
+
+
+def _submit(url_name, kwargs, scope, body):
+    close_old_connections()
+    try:
+        data = SUBMITTERS[url_name](_form(scope, body), **kwargs)
+        ingest_transaction(data)
+        return data['operation']
+    finally:
+        close_old_connections()
+
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if settings.DATA_UPLOAD_MAX_MEMORY_SIZE and len(body) > settings.DATA_UPLOAD_MAX_MEMORY_SIZE:
+            raise SuspiciousOperation('Request body exceeded settings.DATA_UPLOAD_MAX_MEMORY_SIZE.')
+    return body
+
+
+async def _handle(scope, receive):
+    """
+    Status and JSON data of the response, the url name for the metrics
+    """
+    try:
+        match = resolve(scope['path'])
+    except Resolver404:
+        return 404, {'detail': 'Not found.'}, None
+    if match.url_name not in SUBMITTERS:
+        return 404, {'detail': 'Not found.'}, None
+    if scope['method'] != 'POST':
+        return 405, {'detail': 'Method "{}" not allowed.'.format(scope['method'])}, match.url_name
+
+    try:
+        body = await _read_body(receive)
+        operation = await asyncio.get_event_loop().run_in_executor(
+            executor, _submit, match.url_name, match.kwargs, scope, body)
+    except serializers.ValidationError as err:
+        return 400, err.detail, match.url_name
+    except SuspiciousOperation as err:
+        return 400, {'detail': "{}".format(err)}, match.url_name
+    except Exception as err:
+        logging.warning('%s %s: %s', scope['method'], scope['path'], err, exc_info=True)
+        return 500, {'non_field_errors': ["{}".format(err)]}, match.url_name
+    return 200, dict(result="success", message="Transaction {} created".format(operation)), match.url_name
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(executor, transaction_buffer.flush_at_exit)
+            await loop.run_in_executor(executor, metrics.flush)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    started = time.perf_counter()
+    status, data, view = await _handle(scope, receive)
+    body = json.dumps(data).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('latin1')),
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+    if view:
+        metrics.observe('payment_api_request_duration_seconds', time.perf_counter() - started, view=view,
+                        method=scope['method'])
+        metrics.inc('payment_api_responses_total', view=view, status=status)
+        await asyncio.get_event_loop().run_in_executor(executor, metrics.maybe_flush)
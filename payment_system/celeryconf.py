@@ -1,6 +1,7 @@
 import os
 from celery import Celery
 from django.conf import settings
+from kombu import Exchange, Queue
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'payment_system.settings')
@@ -9,5 +10,12 @@ app = Celery('payment-system-worker')
 CELERY_TIMEZONE = 'Europe/Moscow'
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
+# Settlement workers (SETTLEMENT_WORKER=1) consume the queues of all the SETTLEMENT_SHARDS shards instead of the
+# default queue. Every replica takes tasks of every shard, the shards are settled in parallel because every shard
+# run is a task of its own and concurrent runs claim disjoint transactions.
+if int(os.environ.get('SETTLEMENT_WORKER') or 0):
+    # Declared like the queues Celery creates when the tasks are sent to them
+    queues = [settings.SETTLEMENT_QUEUE.format(shard) for shard in range(settings.SETTLEMENT_SHARDS)]
+    app.conf.task_queues = [Queue(queue, Exchange(queue), queue) for queue in queues]
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
@@ -0,0 +1,34 @@
+from payment_system.postgresql import base
+from .creation import DatabaseCreation
+from .pool import get_pool
+
+DEFAULT_POOL = dict(max_size=4, max_idle=300, check_after=30, timeout=10)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend with a connection pool per process, configured by OPTIONS["pool"] (see DEFAULT_POOL).
+    Closing the connection returns it to the pool, so with CONN_MAX_AGE 0 a thread holds a connection only for a
+    request or a task.
+    """
+    creation_class = DatabaseCreation
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('pool', None)
+        return params
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.get_connection_params(),
+                        dict(DEFAULT_POOL, **self.settings_dict['OPTIONS'].get('pool', {})))
+
+    def get_new_connection(self, conn_params):
+        connect = super().get_new_connection
+        connection = self.pool.acquire(lambda: connect(conn_params))
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            self.pool.release(self.connection)
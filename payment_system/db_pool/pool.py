@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+from collections import deque
+from django.db import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+
+class PoolTimeout(OperationalError):
+    """
+    No connection became free in time
+    """
+
+
+def _record(name, value=1, **labels):
+    # The metrics are imported late, they need the apps to be loaded
+    from api.metrics import metrics
+    if name.endswith('_seconds'):
+        metrics.observe(name, value, **labels)
+    else:
+        metrics.inc(name, value, **labels)
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool(object):
+    """
+    Database connections of one process. At most `max_size` connections are open, a caller waits up to `timeout`
+    seconds for a free one. Free connections are closed after `max_idle` seconds and checked with a query before
+    reuse when they were idle for `check_after` seconds or more.
+    """
+
+    def __init__(self, name, max_size, max_idle, check_after, timeout):
+        self.name = name
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self.size = 0
+        self._idle = deque()
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        # Connections inherited from the parent process are its own, they must not be used or closed here
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle.clear()
+            self.size = 0
+
+    def acquire(self, connect):
+        """
+        A free connection of the pool, or a new one opened by `connect` if the pool is not full
+        """
+        started = time.monotonic()
+        with self._condition:
+            self._after_fork()
+            while True:
+                self._close_idle()
+                if self._idle:
+                    connection, released = self._idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    connection = None
+                    break
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    _record('payment_db_pool_connections_total', pool=self.name, event='timeout')
+                    raise PoolTimeout('No free database connection in {}s, pool {} of {} connections'.format(
+                        self.timeout, self.name, self.max_size))
+                self._condition.wait(remaining)
+        _record('payment_db_pool_wait_seconds', time.monotonic() - started, pool=self.name)
+
+        if connection is not None:
+            if time.monotonic() - released < self.check_after or self._check(connection):
+                _record('payment_db_pool_connections_total', pool=self.name, event='reused')
+                return connection
+            # A new connection takes the place of the broken one
+            _close(connection)
+            _record('payment_db_pool_connections_total', pool=self.name, event='broken')
+        try:
+            connection = connect()
+        except Exception:
+            with self._condition:
+                self.size -= 1
+                self._condition.notify()
+            raise
+        _record('payment_db_pool_connections_total', pool=self.name, event='created')
+        return connection
+
+    def release(self, connection):
+        """
+        Return a connection to the pool, an open transaction is rolled back. Broken connections are dropped.
+        """
+        with self._condition:
+            self._after_fork()
+        try:
+            if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except Exception:
+            self._discard(connection, 'broken')
+            return
+        with self._condition:
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+        for connection, _ in idle:
+            self._discard(connection, 'closed')
+
+    def _close_idle(self):
+        # Oldest connections are at the left, the most recently used one is taken from the right
+        while self._idle and time.monotonic() - self._idle[0][1] >= self.max_idle:
+            connection, _ = self._idle.popleft()
+            self.size -= 1
+            _close(connection)
+            _record('payment_db_pool_connections_total', pool=self.name, event='expired')
+
+    def _check(self, connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection, event):
+        _close(connection)
+        with self._condition:
+            self.size -= 1
+            self._condition.notify()
+        _record('payment_db_pool_connections_total', pool=self.name, event=event)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, params, options):
+    """
+    The pool of the process for a database alias and its connection parameters
+    """
+    key = (name, tuple(sorted((key, str(value)) for key, value in params.items())))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(name, **options)
+        return _pools[key]
+
+
+def close_pools():
+    """
+    Close the free connections of every pool of the process
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
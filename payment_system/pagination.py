@@ -1,6 +1,10 @@
+from base64 import b64decode, b64encode
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from collections import OrderedDict
+from django.db import connections
+from django.utils.six.moves.urllib import parse
 
 
 class ResultsSetPagination(PageNumberPagination):
@@ -22,3 +26,88 @@ class ResultsSetPagination(PageNumberPagination):
             ('page_size', self.page.paginator.per_page),
             ('results', data)
         ]))
+
+
+class CursorResultsSetPagination(ResultsSetPagination):
+    """
+    Page number pagination with an opt-in keyset mode. When the `cursor` parameter is passed (empty for the first
+    page) pages are read with pk > / pk < the cursor position instead of OFFSET, and next / previous are opaque
+    cursors. The count is then estimated from the table statistics, `count=exact` gives an exact COUNT(*),
+    `count=none` skips it.
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.current = request.query_params[self.cursor_query_param]
+        position, reverse = self.decode_cursor(self.current)
+        self.count = self.get_count(queryset, request)
+
+        if reverse:
+            page = list(queryset.filter(pk__lt=position).order_by('-pk')[:self.page_size + 1])
+            has_more = len(page) > self.page_size
+            page = page[:self.page_size][::-1]
+            has_previous, has_next = has_more, True
+        else:
+            if position is not None:
+                queryset = queryset.filter(pk__gt=position)
+            page = list(queryset.order_by('pk')[:self.page_size + 1])
+            has_next = len(page) > self.page_size
+            page = page[:self.page_size]
+            has_previous = position is not None
+
+        self.next_cursor = self.encode_cursor(page[-1].pk, False) if page and has_next else None
+        self.previous_cursor = self.encode_cursor(page[0].pk, True) if page and has_previous else None
+        return page
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param, 'estimate')
+        if mode == 'exact':
+            return queryset.count()
+        if mode == 'estimate':
+            return estimate_count(queryset.model, queryset.db)
+
+    def encode_cursor(self, position, reverse):
+        query = parse.urlencode({'p': position, 'r': int(reverse)})
+        return b64encode(query.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None, False
+        try:
+            query = parse.parse_qs(b64decode(cursor.encode('ascii')).decode('ascii'), strict_parsing=True)
+            return int(query['p'][0]), bool(int(query['r'][0]))
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound('Invalid cursor')
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('current', self.current),
+            ('next', self.next_cursor),
+            ('previous', self.previous_cursor),
+            ('page_size', self.page_size),
+            ('results', data)
+        ]))
+
+
+def estimate_count(model, using='default'):
+    """
+    Row count of the model table from the PostgreSQL statistics, None on other databases or before ANALYZE
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    if row and row[0] >= 0:
+        return int(row[0])
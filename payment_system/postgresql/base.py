@@ -0,0 +1,9 @@
+from django.db.backends.postgresql import base
+from .introspection import DatabaseIntrospection
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend that knows the partitioned tables of the api app (migration 0008)
+    """
+    introspection_class = DatabaseIntrospection
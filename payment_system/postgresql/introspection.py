@@ -0,0 +1,20 @@
+from django.db.backends.base.introspection import TableInfo
+from django.db.backends.postgresql import introspection
+
+
+class DatabaseIntrospection(introspection.DatabaseIntrospection):
+
+    def get_table_list(self, cursor):
+        """
+        Tables and views, partitioned tables (relkind "p") included: flush and the test database need them
+        """
+        cursor.execute("""
+            SELECT c.relname, c.relkind
+            FROM pg_catalog.pg_class c
+            LEFT JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'p', 'v')
+                AND n.nspname NOT IN ('pg_catalog', 'pg_toast')
+                AND pg_catalog.pg_table_is_visible(c.oid)""")
+        return [TableInfo(row[0], {'r': 't', 'p': 't', 'v': 'v'}.get(row[1]))
+                for row in cursor.fetchall()
+                if row[0] not in self.ignored_tables]
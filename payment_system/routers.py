@@ -0,0 +1,80 @@
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_state = threading.local()
+# alias: (time of the check, lag in seconds or None if the replica is unavailable)
+_lags = {}
+
+LAG_SQL = '''
+SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+'''
+
+
+@contextmanager
+def read_only():
+    """
+    Reads of the block may go to a replica, until the block writes to the database
+    """
+    previous = getattr(_state, 'read_only', False), getattr(_state, 'pinned', False)
+    _state.read_only, _state.pinned = True, False
+    try:
+        yield
+    finally:
+        _state.read_only, _state.pinned = previous
+
+
+def replica_lag(alias):
+    """
+    Replication lag of a replica in seconds, None if it is unavailable. Checked every REPLICA_LAG_CHECK_INTERVAL.
+    """
+    checked, lag = _lags.get(alias, (None, None))
+    if checked is None or time.monotonic() - checked >= settings.REPLICA_LAG_CHECK_INTERVAL:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                lag = float(cursor.fetchone()[0] or 0)
+        except Exception as err:
+            logging.warning('Replica %s: %s', alias, err)
+            lag = None
+        _lags[alias] = (time.monotonic(), lag)
+    return lag
+
+
+class ReplicaRouter(object):
+    """
+    Writes and ordinary reads go to the primary. Reads in a read_only() block go to a random replica of
+    REPLICA_DATABASES that lags at most REPLICA_MAX_LAG seconds, or to the primary if there is none.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_state, 'read_only', False) or _state.pinned:
+            return None
+        replicas = []
+        for alias in settings.REPLICA_DATABASES:
+            lag = replica_lag(alias)
+            if lag is not None and lag <= settings.REPLICA_MAX_LAG:
+                replicas.append(alias)
+        return random.choice(replicas) if replicas else None
+
+    def db_for_write(self, model, **hints):
+        # Reads after a write see it
+        _state.pinned = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.REPLICA_DATABASES}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        if db in settings.REPLICA_DATABASES:
+            return False
+        return None
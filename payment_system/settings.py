@@ -34,11 +34,15 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',
-    'api',
+    'api.apps.ApiConfig',
     'django_celery_results',
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',
+    'api.middleware.SQLProfilingMiddleware',
+    'api.middleware.JSONErrorMiddleware',
+    'api.middleware.ReplicaReadsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,6 +78,48 @@ DATABASES = {
         default='postgres://postgres:postgres@db/postgres',
         conn_max_age=600)}
 
+# Read replicas of the default database, comma separated URLs, become the replica_N aliases. In tests they mirror
+# the default database.
+REPLICA_DATABASES = []
+for number, replica_url in enumerate(filter(None, (os.environ.get('REPLICA_DATABASE_URLS') or '').split(','))):
+    REPLICA_DATABASES.append('replica_{}'.format(number))
+    DATABASES[REPLICA_DATABASES[-1]] = dict(dj_database_url.parse(replica_url.strip(), conn_max_age=600),
+                                            TEST={'MIRROR': 'default'})
+
+# PostgreSQL databases use payment_system.postgresql: partitioned tables are not known to the Django 1.11 backend.
+# Other backends are left as DATABASE_URL sets them.
+for database in DATABASES.values():
+    if database['ENGINE'] in ('django.db.backends.postgresql', 'django.db.backends.postgresql_psycopg2'):
+        database['ENGINE'] = 'payment_system.postgresql'
+
+# Connection pool per process (DB_POOL=1), set per service: a thread takes a connection from the pool for a request
+# or a task and gives it back after. At most DB_POOL_MAX_SIZE connections per process, a caller waits up to
+# DB_POOL_TIMEOUT seconds for one. Free connections are closed after DB_POOL_MAX_IDLE seconds and checked before
+# reuse after DB_POOL_CHECK_AFTER idle seconds.
+if int(os.environ.get('DB_POOL') or 0):
+    for database in DATABASES.values():
+        if database['ENGINE'] != 'payment_system.postgresql':
+            continue
+        database.update(ENGINE='payment_system.db_pool', CONN_MAX_AGE=0)
+        database.setdefault('OPTIONS', {})['pool'] = dict(
+            max_size=int(os.environ.get('DB_POOL_MAX_SIZE') or 4),
+            max_idle=float(os.environ.get('DB_POOL_MAX_IDLE') or 300),
+            check_after=float(os.environ.get('DB_POOL_CHECK_AFTER') or 30),
+            timeout=float(os.environ.get('DB_POOL_TIMEOUT') or 10))
+
+DATABASE_ROUTERS = ['payment_system.routers.ReplicaRouter']
+
+# Cache shared by the web, ingestion and worker processes: memcached at MEMCACHED_LOCATION (host:port). Without it
+# every process has its own in-memory cache.
+MEMCACHED_LOCATION = os.environ.get('MEMCACHED_LOCATION') or ''
+if MEMCACHED_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': MEMCACHED_LOCATION,
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -124,11 +170,26 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = 'django-db'
+# Tasks do not store their results unless they ask for it (the settlement runs), failures are stored for all tasks.
+# Stored results are kept CELERY_RESULT_EXPIRES seconds.
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_STORE_ERRORS_EVEN_IF_IGNORED = True
+CELERY_RESULT_EXPIRES = int(os.environ.get('CELERY_RESULT_EXPIRES') or 7 * 24 * 60 * 60)
 
+# Transactions are settled when they are created (see SETTLEMENT_COALESCE_WINDOW), the beat run is a safety net
 CELERY_BEAT_SCHEDULE = {
-    'processing-transactions-every-single-minute': {
+    'processing-transactions-safety-net': {
         'task': 'api.tasks.processing_transactions',
-        'schedule': 60.0,
+        'schedule': float(os.environ.get('SETTLEMENT_SAFETY_NET_INTERVAL') or 60),
+    },
+    'create-partitions': {
+        'task': 'api.tasks.create_partitions',
+        'schedule': 24 * 60 * 60,
+    },
+    # Takes the place of the daily celery.backend_cleanup, which deletes all the expired results in one transaction
+    'celery.backend_cleanup': {
+        'task': 'api.tasks.prune_task_results',
+        'schedule': float(os.environ.get('TASK_RESULT_PRUNE_INTERVAL') or 60 * 60),
     },
 }
 
@@ -149,4 +210,99 @@ DATE_INPUT_FORMATS = [
 
 DATE_OUTPUT_FORMAT = '%Y-%m-%d %H:%M:%S'
 """Server-side cursor does not work well when using queryset.iterator (), this leads to hard-to-find bugs that do not even raise the exception, but, for example, simply do not see some records in the database, so we just chop it off"""
-DISABLE_SERVER_SIDE_CURSORS=True
\ No newline at end of file
+DISABLE_SERVER_SIDE_CURSORS=True
+
+# SETTLEMENT SETTINGS
+# Number of pending transactions claimed and settled by one batch of processing_transactions
+SETTLEMENT_BATCH_SIZE = int(os.environ.get('SETTLEMENT_BATCH_SIZE') or 500)
+# Seconds after which a claimed transaction is considered abandoned by its settler and goes back to pending
+SETTLEMENT_CLAIM_TIMEOUT = int(os.environ.get('SETTLEMENT_CLAIM_TIMEOUT') or 600)
+# Times a settlement transaction aborted by PostgreSQL to break a deadlock is retried
+SETTLEMENT_DEADLOCK_RETRIES = int(os.environ.get('SETTLEMENT_DEADLOCK_RETRIES') or 3)
+
+# In-process exchange rate cache: number of currencies kept, seconds before a currency is reloaded from the database
+# and number of latest rates kept per currency. Saved rates drop the cached ones of every process through the default
+# cache (MEMCACHED_LOCATION), with a per-process cache other processes see them after the TTL.
+EXCHANGE_RATE_CACHE_SIZE = int(os.environ.get('EXCHANGE_RATE_CACHE_SIZE') or 256)
+EXCHANGE_RATE_CACHE_TTL = int(os.environ.get('EXCHANGE_RATE_CACHE_TTL') or 60)
+EXCHANGE_RATE_CACHE_MAX_POINTS = int(os.environ.get('EXCHANGE_RATE_CACHE_MAX_POINTS') or 10000)
+
+# The currency registry is reloaded from the database every CURRENCY_REGISTRY_TTL seconds
+CURRENCY_REGISTRY_TTL = int(os.environ.get('CURRENCY_REGISTRY_TTL') or 300)
+
+# Wallet name -> id, currency cache of the by-name endpoints: seconds a wallet is kept and seconds an unknown name
+# is remembered
+WALLET_NAME_CACHE_TTL = int(os.environ.get('WALLET_NAME_CACHE_TTL') or 3600)
+WALLET_NAME_CACHE_NEGATIVE_TTL = int(os.environ.get('WALLET_NAME_CACHE_NEGATIVE_TTL') or 5)
+
+# Pending transactions are partitioned by wallet into SETTLEMENT_SHARDS shards, every shard is settled by its own
+# task on the SETTLEMENT_QUEUE queue. 1 settles everything inside the processing_transactions beat task.
+SETTLEMENT_SHARDS = int(os.environ.get('SETTLEMENT_SHARDS') or 1)
+SETTLEMENT_QUEUE = 'settlement.{}'
+
+# create_transaction signals settlement directly. Signals are coalesced into one run per SETTLEMENT_COALESCE_WINDOW
+# seconds, or started at once when SETTLEMENT_COALESCE_SIZE transactions are waiting. Signals are counted in the
+# default cache, shared by the processes with MEMCACHED_LOCATION. A per-process cache only coalesces the signals
+# of one process.
+SETTLEMENT_COALESCE_WINDOW = float(os.environ.get('SETTLEMENT_COALESCE_WINDOW') or 0.05)
+SETTLEMENT_COALESCE_SIZE = int(os.environ.get('SETTLEMENT_COALESCE_SIZE') or 500)
+
+# How the by-name endpoints create transactions: celery (create_transaction task through the broker), direct
+# (INSERT in the web process) or buffered (in-process buffer written every TRANSACTION_BUFFER_INTERVAL seconds or
+# as soon as TRANSACTION_BUFFER_SIZE transactions are waiting; 0 writes at once). Buffered transactions are answered
+# "success" before they are written: a crash of the web process loses up to TRANSACTION_BUFFER_INTERVAL seconds of
+# them. Under uWSGI buffered mode needs enable-threads.
+TRANSACTION_INGESTION_MODE = os.environ.get('TRANSACTION_INGESTION_MODE') or 'celery'
+TRANSACTION_BUFFER_INTERVAL = float(os.environ.get('TRANSACTION_BUFFER_INTERVAL') or 0.005)
+TRANSACTION_BUFFER_SIZE = int(os.environ.get('TRANSACTION_BUFFER_SIZE') or 500)
+
+# Threads (and database connections) of an ASGI ingestion process for the ORM and the Celery publish
+ASGI_DB_THREADS = int(os.environ.get('ASGI_DB_THREADS') or 16)
+
+# Metrics of every process are added to the shared api_metric table every METRICS_FLUSH_INTERVAL seconds and exported
+# at /metrics/ in the Prometheus text format
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL') or 10)
+
+# Settlement profiling: every SETTLEMENT_PROFILE_EVERY-th run of a worker process is profiled with cProfile, runs
+# slower than SETTLEMENT_PROFILE_SLOW seconds are kept from a sampling profiler (a stack every
+# SETTLEMENT_PROFILE_INTERVAL seconds). 0 is off, `manage.py profile_settlement` switches a running worker.
+# The SETTLEMENT_PROFILE_KEEP latest profiles are kept in SETTLEMENT_PROFILE_DIR.
+SETTLEMENT_PROFILE_DIR = os.environ.get('SETTLEMENT_PROFILE_DIR') or '/tmp/settlement-profiles'
+SETTLEMENT_PROFILE_EVERY = int(os.environ.get('SETTLEMENT_PROFILE_EVERY') or 0)
+SETTLEMENT_PROFILE_SLOW = float(os.environ.get('SETTLEMENT_PROFILE_SLOW') or 0)
+SETTLEMENT_PROFILE_INTERVAL = float(os.environ.get('SETTLEMENT_PROFILE_INTERVAL') or 0.005)
+SETTLEMENT_PROFILE_KEEP = int(os.environ.get('SETTLEMENT_PROFILE_KEEP') or 50)
+
+# Read-only API requests (lists, retrieves, client reports) read from a replica that lags at most REPLICA_MAX_LAG
+# seconds, checked every REPLICA_LAG_CHECK_INTERVAL seconds. A client that wrote reads from the primary for the next
+# REPLICA_PIN_SECONDS (REPLICA_PIN_COOKIE cookie).
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG') or 5)
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL') or 1)
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS') or 10)
+REPLICA_PIN_COOKIE = 'primary_pin'
+
+# Per-request SQL profiling (1 to enable): query count and database time in the X-DB-* response headers
+# (SQL_PROFILING_HEADERS, on in DEBUG), requests over SQL_PROFILING_MAX_QUERIES queries or SQL_PROFILING_SLOW_MS
+# and queries repeated SQL_PROFILING_REPEATED_QUERIES times in a request (N+1) are logged
+SQL_PROFILING = bool(int(os.environ.get('SQL_PROFILING') or 0))
+SQL_PROFILING_HEADERS = bool(int(os.environ.get('SQL_PROFILING_HEADERS') or DEBUG))
+SQL_PROFILING_MAX_QUERIES = int(os.environ.get('SQL_PROFILING_MAX_QUERIES') or 20)
+SQL_PROFILING_SLOW_MS = float(os.environ.get('SQL_PROFILING_SLOW_MS') or 500)
+SQL_PROFILING_REPEATED_QUERIES = int(os.environ.get('SQL_PROFILING_REPEATED_QUERIES') or 5)
+
+# Most transactions accepted by one request of /api/transactions/batch
+TRANSACTION_BATCH_MAX_SIZE = int(os.environ.get('TRANSACTION_BATCH_MAX_SIZE') or 10000)
+
+# Client report files are streamed in chunks of REPORT_CHUNK_SIZE wallet history rows
+REPORT_CHUNK_SIZE = int(os.environ.get('REPORT_CHUNK_SIZE') or 1000)
+# JSON client reports asked for a page (cursor, page_size, since_id, since) have REPORT_PAGE_SIZE rows by default,
+# never more than REPORT_MAX_PAGE_SIZE. Without them the report has all the rows.
+REPORT_PAGE_SIZE = int(os.environ.get('REPORT_PAGE_SIZE') or 100)
+REPORT_MAX_PAGE_SIZE = int(os.environ.get('REPORT_MAX_PAGE_SIZE') or 1000)
+
+# Operations, wallet history and transactions are partitioned by month, the partitions of the next
+# PARTITION_MONTHS_AHEAD months are created daily by the create_partitions beat task
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD') or 3)
+
+# Expired task results are deleted by the prune_task_results beat task in batches of TASK_RESULT_PRUNE_BATCH_SIZE rows
+TASK_RESULT_PRUNE_BATCH_SIZE = int(os.environ.get('TASK_RESULT_PRUNE_BATCH_SIZE') or 5000)
@@ -16,6 +16,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 from payment_system.wsgi.health_check import health_check
+from payment_system.wsgi.metrics import metrics
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'payment_system.settings')
 
@@ -27,3 +28,27 @@ application = get_wsgi_application()
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
 application = health_check(application, '/health/')
+application = metrics(application, '/metrics/')
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+if uwsgi is not None:
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    from api.ingestion import transaction_buffer
+    from api.metrics import metrics as process_metrics
+
+    # The transaction buffer is written by a thread of the worker, without threads nothing is written until it fills
+    if settings.TRANSACTION_INGESTION_MODE == 'buffered' and settings.TRANSACTION_BUFFER_INTERVAL and \
+            not (uwsgi.opt.get('enable-threads') or uwsgi.opt.get('threads')):
+        raise ImproperlyConfigured('TRANSACTION_INGESTION_MODE=buffered needs enable-threads in uWSGI')
+
+    def _flush_at_exit():
+        # uWSGI workers do not reliably run the atexit handlers when they are reloaded or recycled (max-requests)
+        transaction_buffer.flush_at_exit()
+        process_metrics.flush()
+
+    uwsgi.atexit = _flush_at_exit
@@ -0,0 +1,11 @@
+def metrics(application, metrics_url):
+    def metrics_wrapper(environ, start_response):
+        if environ.get('PATH_INFO') == metrics_url:
+            from api.metrics import metrics, render_metrics
+            metrics.flush()
+            body = render_metrics().encode('utf-8')
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        return application(environ, start_response)
+    return metrics_wrapper